@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+runbenchmarks -- times the build stages against synthetic data
+
+Runs index_raw_forms, refine_index, index_proper_names, make_lean_ht
+and the storetodb loaders (against a throwaway SQLite database), with
+the lex iterators and resource caches replaced by the seeded stand-ins
+in benchmarks.synthetic. Results (wall time, CPU time, peak RSS, and
+the counters recorded by the instrumentation layer) are written as
+JSON, and can be compared with an earlier results file.
+
+Usage:
+    python -m benchmarks.runbenchmarks --scale 10 --out results.json
+    python -m benchmarks.runbenchmarks --compare results.json
+    python -m benchmarks.runbenchmarks --check-refine
+
+@author: James McCracken
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import instrumentation
+import resources
+from benchmarks.synthetic import (SyntheticGEL, SyntheticProperNames,
+                                  SyntheticVitalStatisticsCache,
+                                  SyntheticMainSensesCache,
+                                  SyntheticThesaurus)
+
+BENCHMARKS = ('index_raw_forms', 'refine_index', 'index_proper_names',
+              'make_lean_ht', 'store_orm', 'store_bulk', 'store_all',
+              'store_delta')
+
+
+def run(scale=1.0, seed=1, processes=1, only=None):
+    """
+    Run the benchmarks, and return the results as a dict.
+    """
+    work_dir = tempfile.mkdtemp(prefix='tmbench')
+    for subdir in ('raw', 'refined', 'proper_names'):
+        os.makedirs(os.path.join(work_dir, 'form_index', subdir))
+    results = {}
+    try:
+        for name in BENCHMARKS:
+            if only and name not in only:
+                continue
+            print('Running %s...' % name)
+            with globals()['_bench_' + name](work_dir, scale, seed,
+                                             processes) as function:
+                with instrumentation.measure(name) as measurement:
+                    function()
+            results[name] = measurement.as_dict()
+            print('  %.2fs' % results[name]['wall_seconds'])
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        'meta': {
+            'scale': scale,
+            'seed': seed,
+            'processes': processes,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(old, new):
+    """
+    Print a comparison of two sets of results (new/old ratio of
+    wall-clock time for each benchmark).
+    """
+    if old['meta'].get('scale') != new['meta'].get('scale'):
+        print('Warning: comparing results at different scales')
+    print('%-20s %10s %10s %8s' % ('benchmark', 'old (s)', 'new (s)', 'ratio'))
+    for name in BENCHMARKS:
+        if name not in old['results'] or name not in new['results']:
+            continue
+        before = old['results'][name]['wall_seconds']
+        after = new['results'][name]['wall_seconds']
+        print('%-20s %10.2f %10.2f %8.2f' % (name, before, after,
+                                             after / before if before else 0))
+
+
+def check_refine_modes(scale=1.0, seed=1, memory_budget=1):
+    """
+    Refine the synthetic data in memory and in streaming mode, and
+    return a list of the refined files that differ between the two
+    (byte for byte); an empty list means the modes agree.
+    """
+    from build.formindexer import FormIndexer
+    work_dir = tempfile.mkdtemp(prefix='tmcheck')
+    for subdir in ('raw', 'refined', 'proper_names'):
+        os.makedirs(os.path.join(work_dir, 'form_index', subdir))
+    refined_dir = os.path.join(work_dir, 'form_index', 'refined')
+    outputs = {}
+    try:
+        with _form_indexer_patches(work_dir, scale, seed):
+            FormIndexer().index_raw_forms()
+            for mode, budget in (('memory', None), ('streaming', memory_budget)):
+                indexer = FormIndexer(indexed=True)
+                # (memory_budget=None would fall back to the configured
+                #  default, so it's set directly)
+                indexer.memory_budget = budget
+                indexer.refine_index()
+                outputs[mode] = {}
+                for file_name in sorted(os.listdir(refined_dir)):
+                    with open(os.path.join(refined_dir, file_name), 'rb') as filehandle:
+                        outputs[mode][file_name] = filehandle.read()
+                    os.remove(os.path.join(refined_dir, file_name))
+    finally:
+        shutil.rmtree(work_dir)
+    file_names = sorted(set(outputs['memory']) | set(outputs['streaming']))
+    return [file_name for file_name in file_names
+            if outputs['memory'].get(file_name) !=
+            outputs['streaming'].get(file_name)]
+
+
+@contextmanager
+def _patched(module, **attributes):
+    originals = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+
+def _form_indexer_patches(work_dir, scale, seed):
+    from build import formindexer
+    return _patched(
+        formindexer,
+        FORM_INDEX_DIR=os.path.join(work_dir, 'form_index'),
+        entry_iterator=SyntheticGEL(int(2000 * scale), seed).entry_iterator,
+        propernames=SyntheticProperNames(int(500 * scale), seed),
+        VitalStatisticsCache=SyntheticVitalStatisticsCache,
+        MainSensesCache=SyntheticMainSensesCache)
+
+
+@contextmanager
+def _bench_index_raw_forms(work_dir, scale, seed, processes):
+    from build.formindexer import FormIndexer
+    with _form_indexer_patches(work_dir, scale, seed):
+        yield FormIndexer(processes=processes).index_raw_forms
+
+
+@contextmanager
+def _bench_refine_index(work_dir, scale, seed, processes):
+    from build.formindexer import FormIndexer
+    with _form_indexer_patches(work_dir, scale, seed):
+        if not os.listdir(os.path.join(work_dir, 'form_index', 'raw')):
+            FormIndexer(processes=processes).index_raw_forms()
+        yield FormIndexer(processes=processes).refine_index
+
+
+@contextmanager
+def _bench_index_proper_names(work_dir, scale, seed, processes):
+    from build.formindexer import FormIndexer
+    with _form_indexer_patches(work_dir, scale, seed):
+        yield FormIndexer(processes=processes).index_proper_names
+
+
+@contextmanager
+def _bench_make_lean_ht(work_dir, scale, seed, processes):
+    from leanht import makeleanht
+    thesaurus = SyntheticThesaurus(classes=int(5000 * scale), seed=seed)
+    # With more than one process, make_lean_ht divides the files in
+    #  HT_CONTENT_DIR between a pool of workers; placeholders stand in
+    #  for the files, and the synthetic ContentIterator follows them
+    content_dir = None
+    if processes > 1:
+        content_dir = thesaurus.write_placeholders(
+            os.path.join(work_dir, 'ht_content'))
+    with _patched(makeleanht,
+                  ContentIterator=thesaurus.content_iterator,
+                  OUT_DIR=os.path.join(work_dir, 'leanht'),
+                  HT_CONTENT_DIR=content_dir), \
+            resources.override(main_sense_checker=instrumentation.CountingProxy(
+                SyntheticMainSensesCache(seed=seed), 'mainsenses')):
+        yield lambda: makeleanht.make_lean_ht(processes=processes)
+
+
+@contextmanager
+def _storetodb_patches(work_dir, scale, seed):
+    from leanht import storetodb
+    thesaurus = SyntheticThesaurus(classes=int(5000 * scale), seed=seed)
+    db_file = os.path.join(work_dir, 'leanht.db')
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    engine = create_engine('sqlite:///' + db_file)
+    with _patched(storetodb,
+                  ContentIterator=thesaurus.content_iterator,
+                  TaxonomyManager=thesaurus.taxonomy_manager), \
+            resources.override(db_engine=engine,
+                               db_session=sessionmaker(bind=engine)()):
+        yield storetodb
+    engine.dispose()
+
+
+@contextmanager
+def _bench_store_orm(work_dir, scale, seed, processes):
+    with _storetodb_patches(work_dir, scale, seed) as storetodb:
+        def function():
+            storetodb.store_taxonomy(bulk=False)
+            storetodb.store_content(bulk=False)
+        yield function
+
+
+@contextmanager
+def _bench_store_bulk(work_dir, scale, seed, processes):
+    with _storetodb_patches(work_dir, scale, seed) as storetodb:
+        def function():
+            storetodb.store_taxonomy(bulk=True)
+            storetodb.store_content(bulk=True)
+        yield function
+
+
+@contextmanager
+def _bench_store_all(work_dir, scale, seed, processes):
+    with _storetodb_patches(work_dir, scale, seed) as storetodb:
+        yield storetodb.store_all
+
+
+@contextmanager
+def _bench_store_delta(work_dir, scale, seed, processes):
+    # Delta load against tables that are already up to date (i.e. the
+    #  cost of hashing and comparing, with nothing to write)
+    with _storetodb_patches(work_dir, scale, seed) as storetodb:
+        storetodb.store_all()
+        yield storetodb.store_delta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size of the synthetic data (1 = 52k entries, '
+                        '5k thesaurus classes)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS)
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with an earlier results file')
+    parser.add_argument('--check-refine', action='store_true',
+                        help='check that in-memory and streaming refine give '
+                        'byte-identical output, instead of running benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.check_refine:
+        differences = check_refine_modes(scale=args.scale, seed=args.seed)
+        if differences:
+            print('In-memory and streaming refine differ: %s' %
+                  ', '.join(differences))
+            sys.exit(1)
+        print('In-memory and streaming refine give identical output')
+        return
+
+    results = run(scale=args.scale, seed=args.seed, processes=args.processes,
+                  only=args.only)
+    if args.out:
+        with open(args.out, 'w') as filehandle:
+            json.dump(results, filehandle, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as filehandle:
+            compare(json.load(filehandle), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,477 @@
+"""
+synthetic -- seeded stand-ins for the lex resources used by the build
+
+These generate GEL-style entries (with wordclass sets, morphsets and
+types), HT-style thesaurus classes and instances, and lookup caches
+with the same interfaces as the parts of lex.gel, lex.oed.thesaurus,
+lex.oed.resources and lex.propernames that the build code calls. The
+same seed and scale always produce the same data.
+
+@author: James McCracken
+"""
+
+import os
+import random
+import string
+
+WORDCLASSES = ('NN', 'VB', 'JJ', 'RB')
+LANGUAGES = ('French', 'Latin', 'Old English', 'Germanic/Old Norse',
+             'English', 'unknown')
+
+
+def _word(rng, letter, length=None):
+    length = length or rng.randint(3, 12)
+    return letter + ''.join(rng.choice(string.ascii_lowercase)
+                            for _ in range(length - 1))
+
+
+class _Date(object):
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def exact(self, edge):
+        return self.start if edge == 'start' else self.end
+
+
+class SyntheticType(object):
+
+    def __init__(self, form):
+        self.form = form
+        self.sort = form.lower()
+
+    def lemma_manager(self):
+        return self
+
+    def capitalization_type(self):
+        return 'capitalized' if self.form[:1].isupper() else 'lowercase'
+
+
+class SyntheticMorphSet(object):
+
+    def __init__(self, form, forms, start, end, nonstandard):
+        self.form = form
+        self._types = [SyntheticType(f) for f in forms]
+        self._date = _Date(start, end)
+        self._nonstandard = nonstandard
+
+    def types(self):
+        return self._types
+
+    def date(self):
+        return self._date
+
+    def is_nonstandard(self):
+        return self._nonstandard
+
+
+class SyntheticBlock(object):
+
+    def __init__(self, lemma, wordclass, refentry, refid, frequency,
+                 start, end, morphsets):
+        self.lemma = lemma
+        self._wordclass = wordclass
+        self._link = (refentry, refid)
+        self._frequency = frequency
+        self._date = _Date(start, end)
+        self._morphsets = morphsets
+
+    def link(self, target='oed', asTuple=False):
+        return self._link
+
+    def morphsets(self):
+        return self._morphsets
+
+    def frequency(self):
+        return self._frequency
+
+    def definition(self, src='oed'):
+        return 'definition of %s (%s)' % (self.lemma, self._wordclass)
+
+    def wordclass(self):
+        return self._wordclass
+
+    def date(self):
+        return self._date
+
+
+class SyntheticEntry(object):
+
+    def __init__(self, lemma, wordclass, entry_type, start, end, blocks):
+        self.lemma = lemma
+        self._wordclass = wordclass
+        self._entry_type = entry_type
+        self._date = _Date(start, end)
+        self._blocks = blocks
+
+    def date(self):
+        return self._date
+
+    def primary_wordclass(self):
+        return self._wordclass
+
+    def oed_entry_type(self):
+        return self._entry_type
+
+    def us_variant(self):
+        return None
+
+    def wordclass_sets(self):
+        return self._blocks
+
+    def types(self):
+        return [t for block in self._blocks for morphset in block.morphsets()
+                for t in morphset.types()]
+
+
+class SyntheticGEL(object):
+
+    """
+    Generates entries letter by letter; entry_iterator() has the same
+    signature as lex.gel.fileiterator.entry_iterator.
+
+    Forms are deliberately drawn from a limited pool for each letter,
+    so that blocks share types (giving refine_index's de-duplication
+    something to do), and some variants begin with a different letter
+    (alien types).
+    """
+
+    def __init__(self, entries_per_letter=2000, seed=1):
+        self.entries_per_letter = entries_per_letter
+        self.seed = seed
+
+    def entry_iterator(self, letters=None, **kwargs):
+        for letter in (letters or string.ascii_lowercase):
+            rng = random.Random('%d-%s' % (self.seed, letter))
+            pool = [_word(rng, letter)
+                    for _ in range(max(10, self.entries_per_letter))]
+            for i in range(self.entries_per_letter):
+                yield self._entry(rng, letter, pool, i)
+
+    def _entry(self, rng, letter, pool, i):
+        refentry = (ord(letter) - 96) * 1000000 + i + 1
+        lemma = rng.choice(pool)
+        wordclass = rng.choice(WORDCLASSES)
+        if rng.random() < 0.03:
+            wordclass = 'NP'
+            lemma = lemma.capitalize()
+        entry_type = 'entry' if rng.random() < 0.8 else 'subentry'
+        start = rng.randint(900, 1900)
+        end = 2050 if rng.random() < 0.9 else max(start, rng.randint(1500, 1800))
+
+        blocks = []
+        for j in range(rng.randint(1, 3)):
+            morphsets = [SyntheticMorphSet(
+                lemma, [lemma, lemma + 's', lemma + 'ed'], start, end, False)]
+            for _ in range(rng.randint(0, 4)):
+                if rng.random() < 0.1:
+                    variant = _word(rng, rng.choice(string.ascii_lowercase))
+                else:
+                    variant = rng.choice(pool)
+                morphsets.append(SyntheticMorphSet(
+                    variant, [variant, variant + 's'], start,
+                    rng.randint(1500, 2050), rng.random() < 0.1))
+            frequency = rng.choice((round(rng.random() * 10, 2),
+                                    rng.randint(1, 500)))
+            blocks.append(SyntheticBlock(lemma, rng.choice(WORDCLASSES),
+                                         refentry, (j + 1) * 100,
+                                         frequency, start, end, morphsets))
+        return SyntheticEntry(lemma, wordclass, entry_type, start, end,
+                              blocks)
+
+
+class SyntheticProperNames(object):
+
+    """
+    Stand-in for lex.propernames.propernames.
+    """
+
+    def __init__(self, names_per_type=500, seed=1):
+        rng = random.Random(seed)
+        self._names = {name_type: [_word(rng, rng.choice(string.ascii_lowercase)).capitalize()
+                                   for _ in range(names_per_type)]
+                       for name_type in ('firstname', 'surname', 'placename')}
+
+    def names_list(self, name_type):
+        return self._names[name_type]
+
+    def is_common(self, name):
+        return len(name) % 3 == 0
+
+
+class _Record(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SyntheticVitalStatisticsCache(object):
+
+    """
+    Stand-in for lex.oed.resources.vitalstatistics.VitalStatisticsCache.
+    """
+
+    def __init__(self, seed=1, **kwargs):
+        self.seed = seed
+
+    def find(self, refentry, field=None):
+        rng = random.Random('%d-%d' % (self.seed, refentry))
+        if field == 'indirect_language':
+            return rng.choice(LANGUAGES + (None,))
+        if field == 'headword':
+            return None if rng.random() < 0.9 else _word(rng, 'h')
+        return None
+
+
+class SyntheticMainSensesCache(object):
+
+    """
+    Stand-in for lex.oed.resources.mainsenses.MainSensesCache.
+    """
+
+    def __init__(self, seed=1, **kwargs):
+        self.seed = seed
+
+    def find_main_sense_data(self, refentry, refid):
+        rng = random.Random('%d-%d-%s' % (self.seed, refentry, refid))
+        if rng.random() < 0.5:
+            return None
+        return _Record(definition='main sense of %d' % refentry)
+
+    def is_minor_sense(self, refentry, refid, lemma):
+        return (refentry + (refid or 0)) % 7 == 0
+
+    def is_in_minor_homograph(self, refentry, lemma, wordclass):
+        return refentry % 11 == 0
+
+
+class _Node(object):
+
+    """
+    Minimal stand-in for the lxml element interface used by
+    make_lean_ht (getparent, append, remove).
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self.parent = None
+        self.children = []
+
+    def getparent(self):
+        return self.parent
+
+    def append(self, node):
+        if node.parent is not None:
+            node.parent.remove(node)
+        node.parent = self
+        self.children.append(node)
+
+    def remove(self, node):
+        self.children.remove(node)
+        node.parent = None
+
+
+class SyntheticInstance(object):
+
+    def __init__(self, lemma, refentry, refid, start, end):
+        self.node = _Node(self)
+        self._values = (lemma, refentry, refid, start, end)
+
+    def lemma(self):
+        return self._values[0]
+
+    def refentry(self):
+        return self._values[1]
+
+    def refid(self):
+        return self._values[2]
+
+    def start_date(self):
+        return self._values[3]
+
+    def end_date(self):
+        return self._values[4]
+
+
+class SyntheticThesClass(object):
+
+    def __init__(self, id, parent, level, label, wordclass, children):
+        self.node = _Node(self)
+        self._instance_container = _Node()
+        self._id = id
+        self._parent = parent
+        self._level = level
+        self._label = label
+        self._wordclass = wordclass
+        self._children = list(children)
+        self._size = 0
+        self._branch_size = 0
+        self.reload_instances()
+
+    def id(self):
+        return self._id
+
+    def parent(self):
+        return self._parent
+
+    def level(self):
+        return self._level
+
+    def label(self):
+        return self._label
+
+    def wordclass(self, penn=False):
+        return self._wordclass
+
+    def is_wordclass_level(self):
+        return self._label is None
+
+    def breadcrumb(self):
+        return self._label or ''
+
+    def size(self, branch=False):
+        return self._branch_size if branch else self._size
+
+    def reset_size(self, size, branch=False):
+        if branch:
+            self._branch_size = size
+        else:
+            self._size = size
+
+    def add_instance(self, instance):
+        self._instance_container.append(instance.node)
+        self._size += 1
+        self.reload_instances()
+
+    def instances(self):
+        return self._instances
+
+    def reload_instances(self):
+        # Instances moved here by node.append() (e.g. rolled up from a
+        #  child class) are picked up from the class node as well
+        nodes = self._instance_container.children + \
+            [n for n in self.node.children if isinstance(n.owner, SyntheticInstance)]
+        self._instances = [n.owner for n in nodes]
+
+    def child_nodes(self):
+        return list(self._children)
+
+    def remove_child(self, child_id):
+        self._children.remove(child_id)
+
+    def is_leaf_node(self):
+        return not self._children
+
+
+class SyntheticThesaurus(object):
+
+    """
+    Generates a taxonomy of thesaurus classes, with instances attached,
+    split into a number of 'files' (top-level branches).
+    """
+
+    def __init__(self, classes=5000, instances_per_class=4, files=20,
+                 seed=1):
+        rng = random.Random(seed)
+        self.files = [[] for _ in range(files)]
+        # Set by write_placeholders()
+        self._placeholder_dir = None
+        file_nodes = [_Node() for _ in range(files)]
+        self.classes = []
+        branches = {}
+        next_id = [1]
+
+        def make(parent, level, branch):
+            class_id = next_id[0]
+            next_id[0] += 1
+            label = (None if level == 3 else
+                     rng.choice(('kind of', 'types of', 'in', 'thing')) if rng.random() < 0.1
+                     else _word(rng, rng.choice(string.ascii_lowercase)))
+            thesclass = SyntheticThesClass(class_id, parent, level, label,
+                                           rng.choice(WORDCLASSES) if level >= 3 else None,
+                                           [])
+            for _ in range(rng.randint(0, 2 * instances_per_class)):
+                refentry = rng.randint(1, 26000000)
+                thesclass.add_instance(SyntheticInstance(
+                    _word(rng, rng.choice(string.ascii_lowercase)),
+                    refentry, rng.randint(1, 1000),
+                    rng.randint(900, 1900), None))
+            if parent is None:
+                file_nodes[branch].append(thesclass.node)
+            self.files[branch].append(thesclass)
+            self.classes.append(thesclass)
+            branches[class_id] = branch
+            return thesclass
+
+        root_classes = [make(None, 1, i % files) for i in range(files)]
+        frontier = list(root_classes)
+        while len(self.classes) < classes and frontier:
+            parent = frontier.pop(0)
+            for _ in range(rng.randint(1, 4)):
+                if len(self.classes) >= classes:
+                    break
+                child = make(parent.id(), parent.level() + 1,
+                             branches[parent.id()])
+                parent._children.append(child.id())
+                parent.node.append(child.node)
+                frontier.append(child)
+
+        # Branch sizes
+        by_id = {c.id(): c for c in self.classes}
+        for thesclass in sorted(self.classes, key=lambda c: -c.level()):
+            thesclass.reset_size(thesclass.size(branch=True) + thesclass.size(),
+                                 branch=True)
+            if thesclass.parent() is not None:
+                parent = by_id[thesclass.parent()]
+                parent.reset_size(parent.size(branch=True) +
+                                  thesclass.size(branch=True), branch=True)
+
+    def content_iterator(self, **kwargs):
+        """
+        Return a stand-in for lex.oed.thesaurus.contentiterator.ContentIterator
+        (called with the same keyword arguments). If path is a directory
+        of links to placeholders (see write_placeholders()), only the
+        corresponding files are iterated; any other path is ignored.
+        """
+        files = self.files
+        path = kwargs.get('path')
+        if path and self._placeholder_dir and os.path.isdir(path):
+            targets = [os.path.realpath(os.path.join(path, file_name))
+                       for file_name in sorted(os.listdir(path))]
+            if all(os.path.dirname(target) == self._placeholder_dir
+                   for target in targets):
+                files = [self.files[int(os.path.basename(target)[:3])]
+                         for target in targets]
+        return _ContentIterator(files, kwargs.get('yield_mode'))
+
+    def write_placeholders(self, directory):
+        """
+        Write an empty placeholder file to directory for each file of
+        classes, so that the files can be divided into shards (as
+        make_lean_ht() does with the HT content directory).
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for i in range(len(self.files)):
+            open(os.path.join(directory, '%03d.xml' % i), 'w').close()
+        self._placeholder_dir = os.path.realpath(directory)
+        return directory
+
+    def taxonomy_manager(self, **kwargs):
+        return _Record(classes=self.classes)
+
+
+class _ContentIterator(object):
+
+    def __init__(self, files, yield_mode):
+        self.files = files
+        self.yield_mode = yield_mode
+
+    def iterate(self):
+        for classes in self.files:
+            if self.yield_mode == 'file':
+                yield classes
+            else:
+                for thesclass in classes:
+                    yield thesclass
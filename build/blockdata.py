@@ -0,0 +1,186 @@
+"""
+BlockData -- the record for a single wordclass block in the form index
+
+StringTable and TypeSets provide a compact representation of the
+standard/variant/alien type sets of all the blocks in a letter, in
+place of a Python set of (sort, form) tuples for each block.
+
+Each distinct string is stored once in a letter-level StringTable
+(the same table, with the same integer IDs, as is written to the raw
+block file - see build.rawblockfile), and each (sort, form) pair is
+packed into a single integer wordform ID. The type sets of all the
+letter's blocks are then stored end to end in a single shared array
+of wordform IDs, with an array of offsets marking where each block's
+three sets begin and end.
+
+@author: James McCracken
+"""
+
+import array
+from collections import namedtuple
+
+BlockData = namedtuple('BlockData', ['refentry', 'refid', 'type', 'sort',
+            'lemma', 'wordclass', 'definition', 'frequency',
+            'start', 'end', 'language', 'standard_types',
+            'variant_types', 'alien_types'])
+
+# Kinds of type set, in the order in which they're stored for each block
+STANDARD = 0
+VARIANT = 1
+ALIEN = 2
+TYPE_FIELDS = ('standard_types', 'variant_types', 'alien_types')
+
+# Marks a wordform ID that's been removed from a set
+_REMOVED = 0xFFFFFFFFFFFFFFFF
+
+
+def wordform_id(sort_id, form_id):
+    """
+    Pack the string IDs of a (sort, form) pair into a single wordform ID.
+    """
+    return (sort_id << 32) | form_id
+
+
+def split_wordform_id(wordform_id):
+    """
+    Return the (sort ID, form ID) pair packed into a wordform ID.
+    """
+    return wordform_id >> 32, wordform_id & 0xFFFFFFFF
+
+
+class StringTable(object):
+
+    """
+    Letter-level table of strings, each stored once and given an
+    integer ID (in order of first appearance).
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def id(self, value):
+        """
+        Return the ID for a string, adding it if necessary.
+        """
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return self.ids[value]
+
+    def string(self, string_id):
+        return self.values[string_id]
+
+    def wordform_id(self, wordform):
+        """
+        Return the wordform ID for a (sort, form) pair, adding its
+        strings if necessary.
+        """
+        sort, form = wordform
+        return wordform_id(self.id(sort), self.id(form))
+
+
+class TypeSets(object):
+
+    """
+    The standard, variant and alien type sets of a sequence of blocks,
+    stored as wordform IDs in a single shared array.
+
+    Blocks are referred to by position (in the order in which they
+    were added). strings may be a StringTable, or any other object with
+    a string(id) method (e.g. a build.rawblockfile.RawBlockFile), and
+    is used to decode wordform IDs back to (sort, form) pairs.
+
+    Wordforms removed from a set are marked as removed in place, so
+    that the offsets never have to be rewritten.
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+        self._ids = array.array('Q')
+        self._offsets = array.array('I', [0])
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // len(TYPE_FIELDS)
+
+    def append(self, standard_ids, variant_ids, alien_ids):
+        """
+        Add a block's three sets (each an iterable of wordform IDs),
+        and return the block's position.
+        """
+        for ids in (standard_ids, variant_ids, alien_ids):
+            self._ids.extend(sorted(set(ids)))
+            self._offsets.append(len(self._ids))
+        return len(self) - 1
+
+    def add(self, block):
+        """
+        Add the type sets of a block (sets of wordform IDs), and return
+        the block with its type fields emptied.
+        """
+        self.append(block.standard_types, block.variant_types,
+                    block.alien_types)
+        return block._replace(standard_types=None, variant_types=None,
+                              alien_types=None)
+
+    def ids(self, position, kind):
+        """
+        Return a list of the wordform IDs in one of a block's sets.
+        """
+        start, end = self._span(position, kind)
+        return [wordform_id for wordform_id in self._ids[start:end]
+                if wordform_id != _REMOVED]
+
+    def count(self, position, kind):
+        start, end = self._span(position, kind)
+        return end - start - self._ids[start:end].count(_REMOVED)
+
+    def discard(self, position, kind, wordform_id):
+        start, end = self._span(position, kind)
+        try:
+            self._ids[self._ids.index(wordform_id, start, end)] = _REMOVED
+        except ValueError:
+            pass
+
+    def retain(self, position, kind, keep):
+        """
+        Remove the wordforms from one of a block's sets for which
+        keep(wordform ID) is false.
+        """
+        start, end = self._span(position, kind)
+        for i in range(start, end):
+            if self._ids[i] != _REMOVED and not keep(self._ids[i]):
+                self._ids[i] = _REMOVED
+
+    def wordform(self, wordform_id):
+        """
+        Return the (sort, form) pair for a wordform ID.
+        """
+        sort_id, form_id = split_wordform_id(wordform_id)
+        return self.strings.string(sort_id), self.strings.string(form_id)
+
+    def wordforms(self, position, kind):
+        """
+        Return one of a block's sets as a sorted list of (sort, form)
+        pairs.
+        """
+        return sorted(self.wordform(wordform_id) for wordform_id
+                      in self.ids(position, kind))
+
+    def listify(self, block, position):
+        """
+        Return the block with its type fields filled in from its sets,
+        as sorted lists of (sort, form) pairs (as written to the
+        refined index).
+        """
+        return block._replace(**{field: self.wordforms(position, kind)
+                                 for kind, field in enumerate(TYPE_FIELDS)})
+
+    def _span(self, position, kind):
+        i = position * len(TYPE_FIELDS) + kind
+        return self._offsets[i], self._offsets[i + 1]
@@ -0,0 +1,108 @@
+"""
+externalsort -- sort record streams larger than memory
+
+Records (any picklable, mutually comparable objects, e.g. tuples) are
+collected into runs of at most max_records; each run is sorted and
+spilled to a temporary file, and the runs are then merged lazily (at
+most _MERGE_FAN_IN at a time, with larger merged runs merged again as
+necessary). Memory use is bounded by the run size, not by the number
+of records.
+
+@author: James McCracken
+"""
+
+import heapq
+import pickle
+import tempfile
+
+# Maximum number of runs merged at once; with runs read back in batches
+#  of max_records / _MERGE_FAN_IN, a merge holds at most max_records
+#  records in memory
+_MERGE_FAN_IN = 64
+# Upper limit on the number of records pickled together in a run
+_BATCH_SIZE = 10000
+
+
+def external_sort(records, max_records, tmp_dir=None):
+    """
+    Yield the records in sorted order.
+
+    If all the records fit into a single run, they are sorted in memory
+    and nothing is written to disk.
+    """
+    batch_size = max(1, min(_BATCH_SIZE, max_records // _MERGE_FAN_IN))
+    # Runs, grouped by level (level n+1 runs are merged from
+    #  _MERGE_FAN_IN level n runs)
+    levels = [[]]
+    buffer = []
+    try:
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= max_records:
+                buffer.sort()
+                levels[0].append(_spill(buffer, batch_size, tmp_dir))
+                buffer = []
+                _compact(levels, batch_size, tmp_dir)
+        if not levels[0] and len(levels) == 1:
+            buffer.sort()
+            yield from buffer
+            return
+        if buffer:
+            buffer.sort()
+            levels[0].append(_spill(buffer, batch_size, tmp_dir))
+            buffer = []
+        runs = [run for level in levels for run in level]
+        while len(runs) > _MERGE_FAN_IN:
+            merged = _spill(heapq.merge(*[_read_run(run) for run
+                                          in runs[:_MERGE_FAN_IN]]),
+                            batch_size, tmp_dir)
+            for run in runs[:_MERGE_FAN_IN]:
+                run.close()
+            runs = runs[_MERGE_FAN_IN:] + [merged]
+        levels = [runs]
+        yield from heapq.merge(*[_read_run(run) for run in runs])
+    finally:
+        for level in levels:
+            for run in level:
+                run.close()
+
+
+def _compact(levels, batch_size, tmp_dir):
+    # Merge any level that has reached the fan-in limit into a single
+    #  run at the next level up
+    for depth in range(len(levels)):
+        if len(levels[depth]) < _MERGE_FAN_IN:
+            break
+        runs = levels[depth]
+        merged = _spill(heapq.merge(*[_read_run(run) for run in runs]),
+                        batch_size, tmp_dir)
+        for run in runs:
+            run.close()
+        levels[depth] = []
+        if depth + 1 == len(levels):
+            levels.append([])
+        levels[depth + 1].append(merged)
+
+
+def _spill(records, batch_size, tmp_dir):
+    # Write already-sorted records to a temporary file, in batches
+    run = tempfile.TemporaryFile(dir=tmp_dir)
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            pickle.dump(batch, run, protocol=pickle.HIGHEST_PROTOCOL)
+            batch = []
+    if batch:
+        pickle.dump(batch, run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    while True:
+        try:
+            batch = pickle.load(run)
+        except EOFError:
+            return
+        yield from batch
@@ -0,0 +1,438 @@
+"""
+FormIndex -- random-access lookup over the refined form index
+
+write_letter_index() takes a refined/<letter>.json file (as written by
+FormIndexer.refine_index) and writes three files alongside it:
+
+    <letter>.blocks  the same JSON lines, sorted by the block's sort key
+    <letter>.idx     the byte offset of each line in <letter>.blocks
+    <letter>.forms   a wordform table: for each standard, variant and
+                     (allowed) alien type, its sort key, its form, its
+                     kind, and the position of its block, sorted by
+                     sort key
+
+FormIndex memory-maps these files, and answers single and batched
+wordform lookups by binary search (plus a small in-memory hash of
+alien types, which are filed under a letter other than their own),
+without parsing any more of the index than it needs.
+
+@author: James McCracken
+"""
+
+import os
+import sys
+import mmap
+import json
+import array
+import shutil
+import string
+import struct
+import tempfile
+from collections import namedtuple
+
+from build.blockdata import BlockData
+from build.externalsort import external_sort
+
+STANDARD = 0
+VARIANT = 1
+ALIEN = 2
+KIND_NAMES = ('standard', 'variant', 'alien')
+
+_INDEX_MAGIC = b'TMBI'
+_FORMS_MAGIC = b'TMFI'
+VERSION = 2
+# magic, version, (unused), block count; padded to 16 bytes, so that the
+#  offsets array which follows it is 8-byte aligned
+_INDEX_HEADER = struct.Struct('<4sHHI4x')
+# Each section of a .forms file consists of these arrays, in order
+_FORMS_ARRAYS = ('key_offsets', 'form_offsets', 'blocks', 'kinds',
+                 'key_pool', 'form_pool')
+_SECTIONS = ('main', 'alien')
+# Number of index entries buffered before being written out
+_BUFFER_SIZE = 10000
+
+FormMatch = namedtuple('FormMatch', ['sort', 'form', 'kind', 'block'])
+
+
+def write_letter_index(letter, refined_dir, max_records=None):
+    """
+    Write the sorted blocks file, offset index and wordform table for
+    a letter, from refined/<letter>.json.
+
+    The JSON file is read line by line, and the block and wordform
+    records are ordered with build.externalsort.external_sort(); if
+    max_records is given, memory use is bounded by it (as in the
+    streaming refine), rather than by the size of the letter.
+    """
+    if max_records is None:
+        max_records = sys.maxsize
+    in_file = os.path.join(refined_dir, letter + '.json')
+    fields = BlockData._fields
+    sort_field = fields.index('sort')
+    type_fields = [(kind, fields.index(field)) for kind, field in
+                   ((STANDARD, 'standard_types'), (VARIANT, 'variant_types'),
+                    (ALIEN, 'alien_types'))]
+
+    def block_records():
+        # The line number breaks ties, so blocks with the same sort key
+        #  keep their original (refine) order
+        for line_number, (offset, line) in enumerate(_lines(in_file)):
+            yield (json.loads(line)[sort_field] or '', line_number, offset,
+                   len(line))
+
+    # Write the blocks in sort order; this gives each line's new
+    #  position (block number), which is then re-sorted by line number
+    block_numbers = external_sort(
+        _write_sorted_blocks(external_sort(block_records(), max_records),
+                             in_file, _path(refined_dir, letter, 'blocks'),
+                             _path(refined_dir, letter, 'idx')),
+        max_records)
+
+    def form_records():
+        # block_numbers is pulled first, since it's the first read from
+        #  it that runs the (lazy) pass writing .blocks and .idx, even
+        #  if the letter is empty
+        for (_, block_number), (offset, line) in zip(block_numbers,
+                                                     _lines(in_file)):
+            row = json.loads(line)
+            for kind, field in type_fields:
+                section = 1 if kind == ALIEN else 0
+                for sort, form in row[field]:
+                    yield (section, sort, kind, block_number, form)
+
+    writers = [_FormsSectionWriter() for _ in _SECTIONS]
+    try:
+        for section, sort, kind, block_number, form in \
+                external_sort(form_records(), max_records):
+            writers[section].add(sort, kind, block_number, form)
+        _write_container(_path(refined_dir, letter, 'forms'), _FORMS_MAGIC,
+                         [filehandle for writer in writers
+                          for filehandle in writer.finish()])
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _lines(in_file):
+    # Yield (byte offset, line) for each line of a file
+    with open(in_file, 'rb') as filehandle:
+        offset = 0
+        for line in filehandle:
+            yield offset, line
+            offset += len(line)
+
+
+def _write_sorted_blocks(records, in_file, blocks_file, idx_file):
+    """
+    Copy lines from in_file to blocks_file in the order given by the
+    (sort, line number, offset, length) records, writing each line's
+    offset to idx_file; yields (line number, block number) for each.
+    """
+    count = 0
+    position = 0
+    offsets = array.array('Q')
+    with open(in_file, 'rb') as source, open(blocks_file, 'wb') as blocks_out, \
+            open(idx_file, 'wb') as idx_out:
+        # Header is rewritten with the count at the end
+        idx_out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, VERSION, 0, 0))
+        for _, line_number, offset, length in records:
+            source.seek(offset)
+            blocks_out.write(source.read(length))
+            offsets.append(position)
+            if len(offsets) >= _BUFFER_SIZE:
+                idx_out.write(offsets.tobytes())
+                offsets = array.array('Q')
+            position += length
+            yield (line_number, count)
+            count += 1
+        offsets.append(position)
+        idx_out.write(offsets.tobytes())
+        idx_out.seek(0)
+        idx_out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, VERSION, 0, count))
+
+
+class _FormsSectionWriter(object):
+
+    """
+    Accumulates one section of a .forms file (in sort-key order), with
+    each of its arrays spooled to a temporary file.
+    """
+
+    def __init__(self):
+        self.files = [tempfile.TemporaryFile() for _ in _FORMS_ARRAYS]
+        self.key_length = 0
+        self.form_length = 0
+        self._reset()
+        self.key_offsets.append(0)
+        self.form_offsets.append(0)
+
+    def _reset(self):
+        self.key_offsets = array.array('I')
+        self.form_offsets = array.array('I')
+        self.blocks = array.array('I')
+        self.kinds = array.array('B')
+        self.key_pool = bytearray()
+        self.form_pool = bytearray()
+
+    def add(self, sort, kind, block_number, form):
+        sort = sort.encode('utf8')
+        form = form.encode('utf8')
+        self.key_pool += sort
+        self.form_pool += form
+        self.key_length += len(sort)
+        self.form_length += len(form)
+        self.key_offsets.append(self.key_length)
+        self.form_offsets.append(self.form_length)
+        self.blocks.append(block_number)
+        self.kinds.append(kind)
+        if len(self.blocks) >= _BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        for filehandle, data in zip(self.files, (
+                self.key_offsets, self.form_offsets, self.blocks, self.kinds,
+                self.key_pool, self.form_pool)):
+            filehandle.write(bytes(data) if isinstance(data, bytearray)
+                             else data.tobytes())
+        self._reset()
+
+    def finish(self):
+        self._flush()
+        return self.files
+
+    def close(self):
+        for filehandle in self.files:
+            filehandle.close()
+
+
+class FormIndex(object):
+
+    """
+    Lookup API over the indexed refined files in a directory.
+
+    Usage:
+        index = FormIndex(refined_dir)
+        for match in index.lookup('scimitar'):
+            print(match.kind, match.form, match.block.lemma)
+    """
+
+    def __init__(self, refined_dir, letters=string.ascii_lowercase):
+        self.refined_dir = refined_dir
+        self.letters = letters
+        self._letters = {}
+        self._aliens = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for letter_index in self._letters.values():
+            letter_index.close()
+        self._letters = {}
+
+    def lookup(self, sort):
+        """
+        Return a list of FormMatch tuples (sort, form, kind, block) for
+        all the types with the given sort key (as produced by
+        stringtools.lexical_sort), in block order.
+        """
+        matches = []
+        letter_index = self._letter(sort[:1])
+        if letter_index is not None:
+            matches.extend(letter_index.lookup(sort))
+        for letter, block_number, form in self._alien_table().get(sort, []):
+            matches.append(FormMatch(sort, form, KIND_NAMES[ALIEN],
+                                     self._letter(letter).block(block_number)))
+        return matches
+
+    def lookup_many(self, sorts):
+        """
+        Batched lookup: returns a dict mapping each sort key to its list
+        of matches. Keys are looked up in sorted order, so that reads
+        from each letter's files are sequential.
+        """
+        return {sort: self.lookup(sort) for sort in sorted(set(sorts))}
+
+    def __contains__(self, sort):
+        letter_index = self._letter(sort[:1])
+        return ((letter_index is not None and letter_index.contains(sort)) or
+                sort in self._alien_table())
+
+    def block(self, letter, block_number):
+        """
+        Return the block at a given position in a letter's sorted
+        blocks file.
+        """
+        return self._letter(letter).block(block_number)
+
+    def _letter(self, letter):
+        if not letter or letter not in self.letters:
+            return None
+        try:
+            return self._letters[letter]
+        except KeyError:
+            self._letters[letter] = _LetterIndex(self.refined_dir, letter)
+            return self._letters[letter]
+
+    def _alien_table(self):
+        # Alien types are few, and are filed under the letter of the
+        #  block that they belong to, not the letter they begin with;
+        #  so they're collected from all letters into a single hash.
+        if self._aliens is None:
+            self._aliens = {}
+            for letter in self.letters:
+                letter_index = self._letter(letter)
+                for sort, form, block_number in letter_index.aliens():
+                    self._aliens.setdefault(sort, []).append(
+                        (letter, block_number, form))
+        return self._aliens
+
+
+class _LetterIndex(object):
+
+    def __init__(self, refined_dir, letter):
+        self._files = []
+        self._blocks = self._map(_path(refined_dir, letter, 'blocks'))
+        index = self._map(_path(refined_dir, letter, 'idx'))
+        magic, version, _, self.count = _INDEX_HEADER.unpack_from(index, 0)
+        if magic != _INDEX_MAGIC or version != VERSION:
+            raise ValueError('%s: not a block index' %
+                             _path(refined_dir, letter, 'idx'))
+        start = _INDEX_HEADER.size
+        self._offsets = memoryview(index)[
+            start:start + 8 * (self.count + 1)].cast('Q')
+        forms = _Container(self._map(_path(refined_dir, letter, 'forms')),
+                           _FORMS_MAGIC)
+        self._sections = {}
+        for i, section in enumerate(_SECTIONS):
+            self._sections[section] = _FormsSection(
+                *forms.sections[i * len(_FORMS_ARRAYS):
+                                (i + 1) * len(_FORMS_ARRAYS)])
+
+    def _map(self, path):
+        filehandle = open(path, 'rb')
+        if not os.fstat(filehandle.fileno()).st_size:
+            # Empty letter (mmap can't map a zero-length file)
+            filehandle.close()
+            return b''
+        mapped = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append((filehandle, mapped))
+        return mapped
+
+    def close(self):
+        self._offsets.release()
+        for section in self._sections.values():
+            section.release()
+        for filehandle, mapped in self._files:
+            mapped.close()
+            filehandle.close()
+
+    def block(self, block_number):
+        start = self._offsets[block_number]
+        end = self._offsets[block_number + 1]
+        return BlockData(*json.loads(self._blocks[start:end].decode('utf8')))
+
+    def contains(self, sort):
+        section = self._sections['main']
+        key = sort.encode('utf8')
+        i = section.find(key)
+        return i < section.count and section.key(i) == key
+
+    def lookup(self, sort):
+        section = self._sections['main']
+        key = sort.encode('utf8')
+        matches = []
+        i = section.find(key)
+        while i < section.count and section.key(i) == key:
+            matches.append(FormMatch(sort, section.form(i),
+                                     KIND_NAMES[section.kinds[i]],
+                                     self.block(section.blocks[i])))
+            i += 1
+        return matches
+
+    def aliens(self):
+        section = self._sections['alien']
+        for i in range(section.count):
+            yield (section.key(i).decode('utf8'), section.form(i),
+                   section.blocks[i])
+
+
+class _FormsSection(object):
+
+    def __init__(self, key_offsets, form_offsets, blocks, kinds, key_pool,
+                 form_pool):
+        self.key_offsets = key_offsets.cast('I')
+        self.form_offsets = form_offsets.cast('I')
+        self.blocks = blocks.cast('I')
+        self.kinds = kinds.cast('B')
+        self.key_pool = key_pool
+        self.form_pool = form_pool
+        self.count = len(self.blocks)
+
+    def release(self):
+        for view in (self.key_offsets, self.form_offsets, self.blocks,
+                     self.kinds, self.key_pool, self.form_pool):
+            view.release()
+
+    def key(self, i):
+        return bytes(self.key_pool[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    def form(self, i):
+        return bytes(self.form_pool[self.form_offsets[i]:
+                                    self.form_offsets[i + 1]]).decode('utf8')
+
+    def find(self, key):
+        # Leftmost position at which key could be inserted (comparing
+        #  UTF-8 bytes, which sort in the same order as the strings)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def _write_container(path, magic, sections):
+    """
+    Write a list of files (e.g. temporary files) as sections of a single
+    file, with a header giving the (offset, length) of each; sections
+    are 8-byte aligned, so that they can be cast to arrays in place.
+    """
+    header_size = 12 + 16 * len(sections)
+    locations = []
+    offset = header_size
+    for section in sections:
+        offset = (offset + 7) // 8 * 8
+        length = section.seek(0, os.SEEK_END)
+        locations.extend((offset, length))
+        offset += length
+    with open(path, 'wb') as filehandle:
+        filehandle.write(struct.pack('<4sHHI', magic, VERSION, 0,
+                                     len(sections)))
+        filehandle.write(struct.pack('<%dQ' % len(locations), *locations))
+        for section, location in zip(sections, locations[::2]):
+            filehandle.write(b'\0' * (location - filehandle.tell()))
+            section.seek(0)
+            shutil.copyfileobj(section, filehandle)
+
+
+class _Container(object):
+
+    def __init__(self, mapped, magic):
+        found, version, _, count = struct.unpack_from('<4sHHI', mapped, 0)
+        if found != magic or version != VERSION:
+            raise ValueError('Unrecognized index file format')
+        locations = struct.unpack_from('<%dQ' % (2 * count), mapped, 12)
+        view = memoryview(mapped)
+        self.sections = [view[locations[2 * i]:
+                              locations[2 * i] + locations[2 * i + 1]]
+                         for i in range(count)]
+
+
+def _path(refined_dir, letter, extension):
+    return os.path.join(refined_dir, '%s.%s' % (letter, extension))
@@ -6,7 +6,10 @@ FormIndexer
 
 import os
 import string
-from collections import namedtuple, defaultdict
+import tempfile
+import itertools
+import multiprocessing
+from collections import defaultdict
 import pickle
 import json
 
@@ -16,144 +19,117 @@ from lex.propernames import propernames
 from lex.oed.resources.vitalstatistics import VitalStatisticsCache
 from lex.oed.resources.mainsenses import MainSensesCache
 import textmetricsconfig
+import instrumentation
+from instrumentation import CountingProxy
+from pipelinestate import content_fingerprint
+from build.blockdata import (BlockData, StringTable, TypeSets, STANDARD,
+                             VARIANT, ALIEN, split_wordform_id)
+from build.externalsort import external_sort
+from build.formindex import write_letter_index, VERSION as INDEX_VERSION
+from build.propernameindex import write_proper_name_index
+from build.resourcetable import ResourceTable
+from build.rawblockfile import (RawBlockFile, is_raw_block_file,
+                                 write_raw_blocks)
 
 FORM_INDEX_DIR = textmetricsconfig.FORM_INDEX_DIR
 ENTRY_MINIMUM_END_DATE = textmetricsconfig.ENTRY_MINIMUM_END_DATE
 VARIANT_MINIMUM_END_DATE = textmetricsconfig.VARIANT_MINIMUM_END_DATE
 MAX_WORDLENGTH = textmetricsconfig.MAX_WORDLENGTH
-
-BlockData = namedtuple('BlockData', ['refentry', 'refid', 'type', 'sort',
-            'lemma', 'wordclass', 'definition', 'frequency',
-            'start', 'end', 'language', 'standard_types',
-            'variant_types', 'alien_types'])
+INDEX_PROCESSES = textmetricsconfig.INDEX_PROCESSES
+REFINE_MEMORY_BUDGET = textmetricsconfig.REFINE_MEMORY_BUDGET
+REFINED_INDEX = textmetricsconfig.REFINED_INDEX
+# Rough in-memory size of one record in the streaming refine's
+#  external sorts (used to convert the memory budget to a run size,
+#  which also bounds its string cache and resource lookup chunks)
+_BYTES_PER_SORT_RECORD = 400
 
 
 class FormIndexer(object):
 
-    def __init__(self):
-        pass
-
-    def index_raw_forms(self):
-        for letter in string.ascii_lowercase:
-            print('Indexing %s...' % letter)
-            blocks = []
-            for entry in entry_iterator(letters=letter):
-                if (entry.date().end < ENTRY_MINIMUM_END_DATE or
-                        entry.primary_wordclass() in ('NP', 'NPS') or
-                        len(entry.lemma) > MAX_WORDLENGTH):
-                    continue
-                entry_type = entry.oed_entry_type()
-                if entry_type is None:
-                    continue
-                seen = set()
-                for block in entry.wordclass_sets():
-                    # Check that this block is in OED, and does not shadow
-                    #  something already covered (as e.g. vast adv. shadows
-                    #  vast adj.).
-                    refentry, refid = block.link(target='oed', asTuple=True)
-                    if not refentry or (refentry, refid) in seen:
-                        continue
-                    block_data = _store_forms(block, entry, entry_type, letter)
-                    if block_data.standard_types:
-                        blocks.append(block_data)
-                    seen.add((refentry, refid))
-
-            out_file = os.path.join(FORM_INDEX_DIR, 'raw', letter)
-            with open(out_file, 'wb') as filehandle:
-                for block in blocks:
-                    pickle.dump(block, filehandle)
-
-    def refine_index(self):
+    def __init__(self, processes=None, memory_budget=None, indexed=None):
+        """
+        processes: number of worker processes for per-letter indexing.
+        memory_budget: if set (in MB), refine_index() runs in streaming
+        mode, with memory bounded by this budget rather than by the
+        size of the letter.
+        indexed: if True, refine_index() also writes the indexed files
+        read by build.formindex.FormIndex.
+        """
+        if processes is None:
+            processes = INDEX_PROCESSES
+        if memory_budget is None:
+            memory_budget = REFINE_MEMORY_BUDGET
+        if indexed is None:
+            indexed = REFINED_INDEX
+        self.processes = processes
+        self.memory_budget = memory_budget
+        self.indexed = indexed
+
+    def index_raw_forms(self, letters=None, checkpoint=None):
+        """
+        Index forms for each letter into raw/<letter>.
+
+        If a checkpoint is given, letters already done in an interrupted
+        run are skipped, and each letter is checkpointed as it finishes.
+        """
+        letters = letters or list(string.ascii_lowercase)
+        if checkpoint is not None:
+            letters = [l for l in letters if not checkpoint.is_done(l)]
+            callback = checkpoint.done
+        else:
+            callback = None
+        _run_by_letter(_index_raw_letter, self.processes, letters=letters,
+                       callback=callback)
+
+    def refine_index(self, letters=None, checkpoint=None):
+        """
+        Refine raw/<letter> into refined/<letter>.json (plus, in
+        indexed mode, refined/<letter>.blocks, .idx and .forms).
+
+        If a checkpoint is given, letters whose inputs (the raw file,
+        plus the allowed alien types it uses) are unchanged since they
+        were last refined are skipped.
+        """
         allowed_alien_types = _filter_alien_types()
 
-        vitalstats = VitalStatisticsCache()
-        main_sense_checker = MainSensesCache(with_definitions=True)
-        for letter in string.ascii_lowercase:
-            print('Refining index for %s...' % letter)
-            blocks = []
-            for block in raw_pickle_iterator(letter):
-                blocks.append(block)
-
-            # Remove duplicate types, so that only the version
-            #  in the block with the highest frequency is retained.
-            standardmap = defaultdict(list)
-            for i, block in enumerate(blocks):
-                for wordform in block.standard_types:
-                    standardmap[wordform].append((i, block.frequency))
-            for wordform, candidates in standardmap.items():
-                if len(candidates) > 1:
-                    # Sort by frequency
-                    candidates.sort(key=lambda c: c[1], reverse=True)
-                    # Remove the first candidate (the highest-frequency
-                    #  one); this is the one we'll keep.
-                    candidates.pop(0)
-                    # Delete all the rest
-                    for index in [c[0] for c in candidates]:
-                        blocks[index].standard_types.discard(wordform)
-
-            # Remove variant types which either duplicate each other
-            #  or that shadow a standard type (standard types are always
-            #  given precedence).
-            varmap = defaultdict(list)
-            for i, block in enumerate(blocks):
-                for wordform in block.variant_types:
-                    varmap[wordform].append((i, block.frequency))
-            for wordform, candidates in varmap.items():
-                if wordform not in standardmap:
-                    # Sort by frequency
-                    candidates.sort(key=lambda c: c[1], reverse=True)
-                    # Remove the first candidate (the highest-frequency
-                    #  one); this is the one we'll keep.
-                    candidates.pop(0)
-                # Delete all the rest
-                for index in [c[0] for c in candidates]:
-                    blocks[index].variant_types.discard(wordform)
-
-            # Remove any alien types that are not allowed (because they
-            #  shadow other standard types or variants).
-            for block in blocks:
-                to_be_deleted = set()
-                for wordform in block.alien_types:
-                    if wordform not in allowed_alien_types:
-                        to_be_deleted.add(wordform)
-                for wordform in to_be_deleted:
-                    block.alien_types.discard(wordform)
-
-            # Remove any blocks whose standard_types and
-            #  variant_types sets have now been completely emptied
-            # For the remainder, turn standard_forms and variant_forms
-            #  from sets into lists
-            blocks = [_listify_forms(b) for b in blocks if b.standard_types
-                      or b.variant_types]
-
-            blocks_filtered = []
-            for block in blocks:
-                language = vitalstats.find(block.refentry,
-                                           field='indirect_language')
-                if not language and block.start and block.start < 1200:
-                    language = 'West Germanic'
-                block = _replace_language(block, language)
-
-                if block.type == 'entry':
-                    # Make sure we use the OED headword, not the headword
-                    #  that's been used in GEL (which could be the version
-                    #  of the headword found in ODE or NOAD).
-                    headword = vitalstats.find(block.refentry,
-                                               field='headword')
-                    if headword and headword != block.lemma:
-                        block = _replace_lemma(block, headword)
-                    # Make sure we use the correct main-sense definition
-                    main_sense = main_sense_checker.find_main_sense_data(
-                        block.refentry,
-                        block.refid)
-                    if main_sense and main_sense.definition:
-                        block = _replace_definition(block, main_sense.definition)
-                blocks_filtered.append(block)
-
-            out_file = os.path.join(FORM_INDEX_DIR, 'refined', letter + '.json')
-            with open(out_file, 'w') as filehandle:
-                for block in blocks_filtered:
-                    filehandle.write(json.dumps(block) + '\n')
+        letters = letters or list(string.ascii_lowercase)
+        tokens = {}
+        if checkpoint is not None:
+            tokens = {letter: _refine_token(letter, allowed_alien_types)
+                      for letter in letters}
+            letters = [letter for letter in letters if not
+                       (checkpoint.is_done(letter, tokens[letter]) and
+                        os.path.exists(_refined_file(letter)) and
+                        (not self.indexed or
+                         os.path.exists(_refined_file(letter, 'forms'))))]
+        if not letters:
+            return
+
+        vitalstats = CountingProxy(VitalStatisticsCache(), 'vitalstats')
+        main_sense_checker = CountingProxy(
+            MainSensesCache(with_definitions=True), 'mainsenses')
+        if self.memory_budget:
+            max_records = max(1000, self.memory_budget * 1024 * 1024 //
+                              _BYTES_PER_SORT_RECORD)
+        else:
+            max_records = None
+        for letter in letters:
+            with instrumentation.measure(letter) as measurement:
+                if max_records:
+                    _refine_letter_streaming(
+                        letter, allowed_alien_types, vitalstats,
+                        main_sense_checker, max_records)
+                else:
+                    _refine_letter(letter, allowed_alien_types, vitalstats,
+                                   main_sense_checker)
+                if self.indexed:
+                    # (bounded by the same budget as the streaming refine)
+                    write_letter_index(letter,
+                                       os.path.join(FORM_INDEX_DIR, 'refined'),
+                                       max_records=max_records)
+            instrumentation.add_letter(letter, measurement.as_dict())
+            if checkpoint is not None:
+                checkpoint.done(letter, tokens[letter])
 
     def index_proper_names(self):
         allnames = set()
@@ -163,28 +139,471 @@ class FormIndexer(object):
                     continue
                 allnames.add(name)
 
-        for letter in string.ascii_lowercase:
-            print('Indexing proper names in %s...' % letter)
-            for entry in entry_iterator(letters=letter):
-                if entry.primary_wordclass() not in ('NP', 'NPS'):
-                    continue
-                for typeunit in entry.types():
-                    if (' ' in typeunit.form or
-                        not typeunit.lemma_manager().capitalization_type() == 'capitalized'):
-                        continue
-                    allnames.add(typeunit.form)
+        for letter_names in _run_by_letter(_proper_names_in_letter,
+                                           self.processes):
+            allnames |= letter_names
+
+        entries = []
+        for name in allnames:
+            sortable = stringtools.lexical_sort(name)
+            if (not sortable or
+                    len(sortable) > MAX_WORDLENGTH or
+                    len(name) > MAX_WORDLENGTH):
+                continue
+            entries.append((sortable, name, propernames.is_common(name)))
+        entries.sort()
+
+        # Sorted text version, plus a compact binary index (see
+        #  build.propernameindex.ProperNameIndex)
+        out_dir = os.path.join(FORM_INDEX_DIR, 'proper_names')
+        with open(os.path.join(out_dir, 'all.txt'), 'w') as filehandle:
+            for sortable, name, is_common in entries:
+                filehandle.write('%s\t%s\t%s\n' % (sortable, name,
+                                                   str(is_common)))
+        write_proper_name_index(os.path.join(out_dir, 'all.idx'), entries)
+
+
+def _run_by_letter(function, processes, letters=None, callback=None):
+    """
+    Apply function to each letter of the alphabet (or to the letters
+    given), either in-process or fanned out across a pool of worker
+    processes.
+
+    Results are returned in alphabetical order of letter, whichever
+    mode is used, so that output is deterministic. If a callback is
+    given, it's called with each letter as that letter's result
+    comes in.
+    """
+    if letters is None:
+        letters = list(string.ascii_lowercase)
+    if not letters:
+        return []
+    function = _MeasuredLetter(function)
+    if processes is None or processes <= 1:
+        results = map(function, letters)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=min(processes, len(letters)))
+        results = pool.imap(function, letters, chunksize=1)
+    try:
+        collected = []
+        for letter, (result, measurements) in zip(letters, results):
+            instrumentation.add_letter(letter, measurements)
+            collected.append(result)
+            if callback is not None:
+                callback(letter)
+        return collected
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+class _MeasuredLetter(object):
+
+    """
+    Wraps a per-letter function so that it returns its result together
+    with the letter's measurements (which can then be passed back from
+    a worker process).
+    """
 
-        out_file = os.path.join(FORM_INDEX_DIR, 'proper_names', 'all.txt')
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, letter):
+        with instrumentation.measure(letter) as measurement:
+            result = self.function(letter)
+        return result, measurement.as_dict()
+
+
+def _refine_letter(letter, allowed_alien_types, vitalstats,
+                   main_sense_checker):
+    print('Refining index for %s...' % letter)
+    with _open_raw_letter(letter) as raw_file:
+        # Type sets are kept as the raw file's wordform IDs, so that the
+        #  de-duplication below works on integers
+        typesets = TypeSets(raw_file)
+        blocks = [typesets.add(block) for block
+                  in raw_file.blocks_with_type_ids()]
+        instrumentation.count('blocks_read', len(blocks))
+        blocks = _dedup_types(blocks, typesets, allowed_alien_types)
+
+    resources = ResourceTable.for_blocks(blocks, vitalstats,
+                                         main_sense_checker)
+    blocks_filtered = [_finalize_block(block, resources) for block in blocks]
+
+    out_file = _refined_file(letter)
+    with open(out_file, 'w') as filehandle:
+        for block in blocks_filtered:
+            filehandle.write(json.dumps(block) + '\n')
+    instrumentation.count('blocks_written', len(blocks_filtered))
+
+
+def _dedup_types(blocks, typesets, allowed_alien_types):
+    """
+    Resolve duplicate types between the blocks (whose type sets are
+    in typesets), and return the blocks that still have standard or
+    variant types, with their type sets as sorted lists.
+    """
+    # Remove duplicate types, so that only the version
+    #  in the block with the highest frequency is retained.
+    standardmap = defaultdict(list)
+    for i, block in enumerate(blocks):
+        for form_id in typesets.ids(i, STANDARD):
+            standardmap[form_id].append((i, block.frequency))
+    for form_id, candidates in standardmap.items():
+        if len(candidates) > 1:
+            # Sort by frequency
+            candidates.sort(key=lambda c: c[1], reverse=True)
+            # Remove the first candidate (the highest-frequency
+            #  one); this is the one we'll keep.
+            candidates.pop(0)
+            # Delete all the rest
+            for index in [c[0] for c in candidates]:
+                typesets.discard(index, STANDARD, form_id)
+
+    # Remove variant types which either duplicate each other
+    #  or that shadow a standard type (standard types are always
+    #  given precedence).
+    varmap = defaultdict(list)
+    for i, block in enumerate(blocks):
+        for form_id in typesets.ids(i, VARIANT):
+            varmap[form_id].append((i, block.frequency))
+    for form_id, candidates in varmap.items():
+        if form_id not in standardmap:
+            # Sort by frequency
+            candidates.sort(key=lambda c: c[1], reverse=True)
+            # Remove the first candidate (the highest-frequency
+            #  one); this is the one we'll keep.
+            candidates.pop(0)
+        # Delete all the rest
+        for index in [c[0] for c in candidates]:
+            typesets.discard(index, VARIANT, form_id)
+
+    # Remove any alien types that are not allowed (because they
+    #  shadow other standard types or variants).
+    def is_allowed(form_id):
+        return typesets.wordform(form_id) in allowed_alien_types
+    for i in range(len(blocks)):
+        typesets.retain(i, ALIEN, is_allowed)
+
+    # Remove any blocks whose standard_types and
+    #  variant_types sets have now been completely emptied
+    # For the remainder, turn standard_forms and variant_forms
+    #  into lists
+    return [typesets.listify(block, i) for i, block in enumerate(blocks)
+            if typesets.count(i, STANDARD) or typesets.count(i, VARIANT)]
+
+
+def _refine_letter_streaming(letter, allowed_alien_types, vitalstats,
+                             main_sense_checker, max_records):
+    """
+    Same as _refine_letter(), but with memory use bounded by max_records
+    rather than by the size of the letter.
+
+    The de-duplication of standard and variant types is resolved by
+    external sort-merge: a first pass over the raw blocks emits one
+    (wordform ID, kind, frequency, block index) record per type; these
+    are sorted by wordform, and each wordform's group is resolved
+    exactly as in _refine_letter(), giving a list of deletions. The
+    deletions are sorted by block index, and applied in a second
+    streaming pass over the raw blocks; the blocks that survive are
+    spooled to a temporary file, and their resource lookup keys to
+    another. The keys are sorted by refentry and resolved a chunk at a
+    time (each chunk with its own ResourceTable); the results are
+    sorted back into block order, and applied to the spooled blocks
+    as they're written out.
+
+    Strings are read from the raw file through a cache of at most
+    max_records strings. (An old-style pickled raw file is read through
+    a _PickledRawFile, whose string table does grow with the letter.)
+    """
+    print('Refining index for %s (streaming)...' % letter)
+    survivors = tempfile.TemporaryFile()
+    lookups = tempfile.TemporaryFile()
+    try:
+        with _open_raw_letter(letter, string_cache=max_records) as raw_file:
+            blocks_read, blocks_written = _spool_survivors(
+                raw_file, allowed_alien_types, max_records, survivors,
+                lookups)
+        survivors.seek(0)
+        lookups.seek(0)
+
+        # Third pass: resolve the lookups a chunk of refentries at a
+        #  time, and sort the results back into block order
+        def resolutions():
+            keys = external_sort(_read_pickles(lookups), max_records)
+            for chunk in _refentry_chunks(keys, max_records):
+                resources = ResourceTable.build(
+                    (refentry for refentry, _, _, _ in chunk),
+                    ((refentry, None if refid == -1 else refid)
+                     for refentry, refid, is_entry, _ in chunk if is_entry),
+                    vitalstats, main_sense_checker)
+                instrumentation.count('resource_chunks')
+                for refentry, refid, is_entry, i in chunk:
+                    yield (i,) + _lookup_resources(
+                        refentry, None if refid == -1 else refid, is_entry,
+                        resources)
+        resolved = external_sort(resolutions(), max_records)
+
+        # Fourth pass: finalize the surviving blocks and write them out
+        out_file = _refined_file(letter)
         with open(out_file, 'w') as filehandle:
-            for name in allnames:
-                sortable = stringtools.lexical_sort(name)
-                if (not sortable or
-                        len(sortable) > MAX_WORDLENGTH or
-                        len(name) > MAX_WORDLENGTH):
-                    continue
-                filehandle.write('%s\t%s\t%s\n' % (sortable,
-                                                   name,
-                                                   str(propernames.is_common(name))))
+            for block, resolution in zip(_read_pickles(survivors), resolved):
+                block = _apply_resources(BlockData(*block), *resolution[1:])
+                filehandle.write(json.dumps(block) + '\n')
+    finally:
+        survivors.close()
+        lookups.close()
+    instrumentation.count('blocks_read', blocks_read)
+    instrumentation.count('blocks_written', blocks_written)
+
+
+def _spool_survivors(raw_file, allowed_alien_types, max_records, survivors,
+                     lookups):
+    """
+    The first two passes of _refine_letter_streaming(): pickle each
+    block that survives de-duplication to survivors (with its type sets
+    as sorted lists), and a (refentry, refid, is entry, position) lookup
+    key for it to lookups.
+
+    Returns the number of blocks read and the number spooled.
+    """
+    def type_records():
+        for i, block in enumerate(raw_file.blocks_with_type_ids()):
+            key = _frequency_key(block.frequency)
+            for form_id in block.standard_types:
+                yield (form_id, STANDARD, key, i)
+            for form_id in block.variant_types:
+                yield (form_id, VARIANT, key, i)
+
+    def deletions():
+        records = external_sort(type_records(), max_records)
+        for form_id, group in itertools.groupby(records, key=lambda r: r[0]):
+            # Within each group, standard types come first, then
+            #  variants; each sorted by descending frequency, and then
+            #  by block index (matching the stable sort in _refine_letter)
+            standard = []
+            variant = []
+            for _, kind, _, i in group:
+                (standard if kind == STANDARD else variant).append(i)
+            # Keep only the highest-frequency standard type
+            for i in standard[1:]:
+                yield (i, STANDARD, form_id)
+            # Variants are dropped altogether if they shadow a standard
+            #  type; otherwise keep the highest-frequency one
+            for i in (variant if standard else variant[1:]):
+                yield (i, VARIANT, form_id)
+
+    # Second pass: apply the deletions (so that nothing is spooled or
+    #  looked up for blocks that end up empty)
+    pending = external_sort(deletions(), max_records)
+    deletion = next(pending, None)
+    blocks_read = 0
+    blocks_spooled = 0
+    for i, block in enumerate(raw_file.blocks_with_type_ids()):
+        blocks_read += 1
+        while deletion is not None and deletion[0] == i:
+            if deletion[1] == STANDARD:
+                block.standard_types.remove(deletion[2])
+            else:
+                block.variant_types.remove(deletion[2])
+            deletion = next(pending, None)
+        if not block.standard_types and not block.variant_types:
+            continue
+        block = _decode_types(block, raw_file, allowed_alien_types)
+        refid = -1 if block.refid is None else block.refid
+        pickle.dump(tuple(block), survivors, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump((block.refentry, refid, block.type == 'entry',
+                     blocks_spooled), lookups,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        blocks_spooled += 1
+    return blocks_read, blocks_spooled
+
+
+def _decode_types(block, raw_file, allowed_alien_types):
+    """
+    Turn a block's type sets from lists of wordform IDs into sorted
+    lists of (sort, form) pairs, dropping any alien types that are
+    not allowed.
+    """
+    def wordforms(form_ids):
+        return sorted((raw_file.string(sort_id), raw_file.string(form_id))
+                      for sort_id, form_id in map(split_wordform_id,
+                                                  form_ids))
+    return block._replace(
+        standard_types=wordforms(block.standard_types),
+        variant_types=wordforms(block.variant_types),
+        alien_types=[wordform for wordform in wordforms(block.alien_types)
+                     if wordform in allowed_alien_types])
+
+
+def _refentry_chunks(records, size):
+    """
+    Group records sorted by refentry (their first item) into lists of
+    about size records, without splitting any refentry's records
+    between two lists.
+    """
+    chunk = []
+    for _, group in itertools.groupby(records, key=lambda r: r[0]):
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+    if chunk:
+        yield chunk
+
+
+def _read_pickles(filehandle):
+    while 1:
+        try:
+            yield pickle.load(filehandle)
+        except EOFError:
+            break
+
+
+def _frequency_key(frequency):
+    # Sorts highest frequency first; blocks with no frequency come last
+    if frequency is None:
+        return float('inf')
+    return -frequency
+
+
+def _finalize_block(block, resources):
+    """
+    Set the language, and (for entries) the OED headword and main-sense
+    definition, of a refined block (looked up in the letter's
+    ResourceTable).
+    """
+    return _apply_resources(block, *_lookup_resources(
+        block.refentry, block.refid, block.type == 'entry', resources))
+
+
+def _lookup_resources(refentry, refid, is_entry, resources):
+    """
+    Return the (language, headword, definition) for a block from a
+    ResourceTable (headword and definition only for entries).
+    """
+    language = resources.language(refentry)
+    if not is_entry:
+        return language, None, None
+    return (language, resources.headword(refentry),
+            resources.main_sense_definition(refentry, refid))
+
+
+def _apply_resources(block, language, headword, definition):
+    if not language and block.start and block.start < 1200:
+        language = 'West Germanic'
+    block = _replace_language(block, language)
+
+    if block.type == 'entry':
+        # Make sure we use the OED headword, not the headword
+        #  that's been used in GEL (which could be the version
+        #  of the headword found in ODE or NOAD).
+        if headword and headword != block.lemma:
+            block = _replace_lemma(block, headword)
+        # Make sure we use the correct main-sense definition
+        if definition:
+            block = _replace_definition(block, definition)
+    return block
+
+
+def _refined_file(letter, extension='json'):
+    return os.path.join(FORM_INDEX_DIR, 'refined', '%s.%s' % (letter, extension))
+
+
+def _refine_token(letter, allowed_alien_types):
+    """
+    Return a fingerprint of everything that refining this letter depends
+    on: the raw file, those of its alien types which are allowed, and
+    the version of the indexed file format.
+    """
+    in_file = os.path.join(FORM_INDEX_DIR, 'raw', letter)
+    letter_aliens, _ = _read_type_index(letter)
+    allowed = sorted(letter_aliens & allowed_alien_types)
+    return content_fingerprint(in_file, json.dumps(allowed),
+                               str(INDEX_VERSION))
+
+
+def _index_raw_letter(letter):
+    print('Indexing %s...' % letter)
+    # Type sets are stored as wordform IDs over a string table for the
+    #  letter, which is also the raw file's string table
+    strings = StringTable()
+    typesets = TypeSets(strings)
+    blocks = []
+    entries_scanned = 0
+    for entry in entry_iterator(letters=letter):
+        entries_scanned += 1
+        if (entry.date().end < ENTRY_MINIMUM_END_DATE or
+                entry.primary_wordclass() in ('NP', 'NPS') or
+                len(entry.lemma) > MAX_WORDLENGTH):
+            continue
+        entry_type = entry.oed_entry_type()
+        if entry_type is None:
+            continue
+        seen = set()
+        for block in entry.wordclass_sets():
+            # Check that this block is in OED, and does not shadow
+            #  something already covered (as e.g. vast adv. shadows
+            #  vast adj.).
+            refentry, refid = block.link(target='oed', asTuple=True)
+            if not refentry or (refentry, refid) in seen:
+                continue
+            block_data = _store_forms(block, entry, entry_type, letter,
+                                      strings)
+            if block_data.standard_types:
+                blocks.append(typesets.add(block_data))
+            seen.add((refentry, refid))
+
+    out_file = os.path.join(FORM_INDEX_DIR, 'raw', letter)
+    write_raw_blocks(out_file, blocks, typesets)
+    _write_type_index(letter, typesets)
+    instrumentation.count('entries_scanned', entries_scanned)
+    instrumentation.count('blocks_emitted', len(blocks))
+    return letter
+
+
+def _proper_names_in_letter(letter):
+    print('Indexing proper names in %s...' % letter)
+    names = set()
+    entries_scanned = 0
+    for entry in entry_iterator(letters=letter):
+        entries_scanned += 1
+        if entry.primary_wordclass() not in ('NP', 'NPS'):
+            continue
+        for typeunit in entry.types():
+            if (' ' in typeunit.form or
+                not typeunit.lemma_manager().capitalization_type() == 'capitalized'):
+                continue
+            names.add(typeunit.form)
+    instrumentation.count('entries_scanned', entries_scanned)
+    instrumentation.count('names_found', len(names))
+    return names
+
+
+def raw_block_iterator(letter):
+    """
+    Yield each block from the raw file for the letter, whether it's
+    a binary raw block file or an old-style stream of pickles.
+    """
+    in_file = os.path.join(FORM_INDEX_DIR, 'raw', letter.lower())
+    if not is_raw_block_file(in_file):
+        yield from raw_pickle_iterator(letter)
+        return
+    with RawBlockFile(in_file) as raw_file:
+        yield from raw_file
+
+
+def _open_raw_letter(letter, string_cache=None):
+    """
+    Open the raw file for the letter, returning either a RawBlockFile
+    (with the given string cache size) or, for an old-style stream of
+    pickles, a _PickledRawFile.
+    """
+    in_file = os.path.join(FORM_INDEX_DIR, 'raw', letter.lower())
+    if is_raw_block_file(in_file):
+        return RawBlockFile(in_file, string_cache=string_cache)
+    return _PickledRawFile(letter)
 
 
 def raw_pickle_iterator(letter):
@@ -199,21 +618,55 @@ def raw_pickle_iterator(letter):
                 yield(block)
 
 
-def _store_forms(block, entry, block_type, letter):
+class _PickledRawFile(object):
+
+    """
+    Stand-in for a RawBlockFile, for an old-style raw file of pickled
+    blocks: wordform IDs are assigned over a StringTable as the
+    blocks are read.
+    """
+
+    def __init__(self, letter):
+        self.letter = letter
+        self.strings = StringTable()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def string(self, string_id):
+        return self.strings.string(string_id)
+
+    def blocks_with_type_ids(self):
+        wordform_id = self.strings.wordform_id
+        for block in raw_pickle_iterator(self.letter):
+            yield block._replace(
+                standard_types=[wordform_id(w) for w in block.standard_types],
+                variant_types=[wordform_id(w) for w in block.variant_types],
+                alien_types=[wordform_id(w) for w in block.alien_types])
+
+
+def _store_forms(block, entry, block_type, letter, strings):
+    """
+    Return the BlockData for a block, with its type sets as sets of
+    wordform IDs over the letter's StringTable.
+    """
     us_variant = entry.us_variant()
     standardtypes = set()
     varianttypes = set()
     alientypes = set()
     for morphset in block.morphsets():
         if morphset.form in (entry.lemma, us_variant, block.lemma):
-            _add_types(morphset, standardtypes, letter)
+            _add_types(morphset, standardtypes, letter, strings)
         elif (block_type == 'entry' and
                 morphset.date().end > VARIANT_MINIMUM_END_DATE and
                 not morphset.is_nonstandard()):
             # Don't store variants for subentries; don't store
             #  very old or non-standard variants
-            _add_types(morphset, varianttypes, letter)
-            _add_alien_variants(morphset, alientypes, letter)
+            _add_types(morphset, varianttypes, letter, strings)
+            _add_alien_variants(morphset, alientypes, letter, strings)
     varianttypes = varianttypes - standardtypes
     alientypes = alientypes - standardtypes
 
@@ -243,16 +696,16 @@ def _store_forms(block, entry, block_type, letter):
                      alientypes,)
 
 
-def _add_types(morphset, target_set, letter):
+def _add_types(morphset, target_set, letter, strings):
     for t in morphset.types():
         if len(t.sort) > MAX_WORDLENGTH or len(t.form) > MAX_WORDLENGTH:
             continue
         if not t.sort.startswith(letter):
             continue
-        target_set.add((t.sort, t.form))
+        target_set.add(strings.wordform_id((t.sort, t.form)))
 
 
-def _add_alien_variants(morphset, target_set, letter):
+def _add_alien_variants(morphset, target_set, letter, strings):
     """
     Store variants that start with a letter *other* than the current
     letter (e.g. 'cimiter' under 'scimitar').
@@ -262,13 +715,7 @@ def _add_alien_variants(morphset, target_set, letter):
             continue
         if t.sort.startswith(letter):
             continue
-        target_set.add((t.sort, t.form))
-
-
-def _listify_forms(entry):
-    return entry._replace(standard_types=list(entry.standard_types),
-                          variant_types=list(entry.variant_types),
-                          alien_types=list(entry.alien_types))
+        target_set.add(strings.wordform_id((t.sort, t.form)))
 
 
 def _replace_lemma(entry, headword):
@@ -308,23 +755,58 @@ def _filter_alien_types():
     and which therefore may shadow lemmas or variants in other
     letter sets.)
     """
-    # Store all the alien types
     alien_types = set()
+    native_types = set()
     for letter in string.ascii_lowercase:
-        for block in raw_pickle_iterator(letter):
-            alien_types = alien_types | block.alien_types
+        letter_aliens, letter_natives = _read_type_index(letter)
+        alien_types.update(letter_aliens)
+        native_types.update(letter_natives)
 
     # Delete any which shadow standard types or other variants (ie. those
     #  which are not aliens, in their own letter sets).
-    for letter in string.ascii_lowercase:
-        for block in raw_pickle_iterator(letter):
-            for typelist in (block.standard_types, block.variant_types):
-                for wordform in typelist:
-                    try:
-                        alien_types.discard(wordform)
-                    except KeyError:
-                        pass
-
+    alien_types -= native_types
     return alien_types
 
 
+def _type_index_file(letter):
+    return os.path.join(FORM_INDEX_DIR, 'raw', letter.lower() + '.types.json')
+
+
+def _write_type_index(letter, typesets):
+    """
+    Write a sidecar to the raw file for this letter, listing all the
+    alien types, and all the standard and variant types ('native' types)
+    found in the letter's blocks (given as a TypeSets).
+    """
+    alien_ids = set()
+    native_ids = set()
+    for i in range(len(typesets)):
+        alien_ids.update(typesets.ids(i, ALIEN))
+        native_ids.update(typesets.ids(i, STANDARD))
+        native_ids.update(typesets.ids(i, VARIANT))
+    with open(_type_index_file(letter), 'w') as filehandle:
+        json.dump({'alien': sorted(map(typesets.wordform, alien_ids)),
+                   'native': sorted(map(typesets.wordform, native_ids))},
+                  filehandle)
+
+
+def _read_type_index(letter):
+    """
+    Return a 2-ple of sets (alien types, native types) for the letter.
+
+    Falls back to scanning the raw file (and writing the sidecar for
+    next time) if the sidecar is missing, e.g. for raw files written
+    before sidecars were introduced.
+    """
+    try:
+        with open(_type_index_file(letter)) as filehandle:
+            data = json.load(filehandle)
+    except FileNotFoundError:
+        with _open_raw_letter(letter) as raw_file:
+            typesets = TypeSets(raw_file)
+            for block in raw_file.blocks_with_type_ids():
+                typesets.add(block)
+            _write_type_index(letter, typesets)
+        return _read_type_index(letter)
+    return (set(tuple(wordform) for wordform in data['alien']),
+            set(tuple(wordform) for wordform in data['native']))
@@ -0,0 +1,235 @@
+"""
+ProperNameIndex -- compact sorted index of proper names
+
+write_proper_name_index() writes a list of (sortable, name, is_common)
+entries, de-duplicated and sorted by sortable (the lexical_sort form of
+the name), to a single binary file:
+
+  - the entries' keys ('sortable\\0name', as UTF-8) are front-coded in
+    blocks of BLOCK_SIZE: the first key in each block is stored in full,
+    and each subsequent key as the length of the prefix it shares with
+    the previous key, plus the remaining suffix;
+  - an array of block offsets, for binary search on each block's first
+    key;
+  - a bitmap of is_common flags, one bit per entry.
+
+ProperNameIndex memory-maps the file, and supports exact-match and
+prefix queries on the sortable form; a query decodes at most a couple
+of blocks, plus the blocks holding the matches.
+
+@author: James McCracken
+"""
+
+import mmap
+import array
+import struct
+
+MAGIC = b'TMPN'
+VERSION = 1
+BLOCK_SIZE = 16
+# magic, version, block size, entry count, block count
+_HEADER = struct.Struct('<4sHHII')
+# Separates sortable from name in each key; sorts before any character,
+#  so key order is the same as (sortable, name) order
+_SEPARATOR = b'\0'
+
+
+def write_proper_name_index(out_file, entries):
+    """
+    Write (sortable, name, is_common) entries to out_file. Duplicate
+    (sortable, name) pairs are dropped (the first one's is_common flag
+    is kept). Returns the number of entries written.
+    """
+    seen = {}
+    for sortable, name, is_common in entries:
+        key = sortable.encode('utf8') + _SEPARATOR + name.encode('utf8')
+        if key not in seen:
+            seen[key] = bool(is_common)
+    keys = sorted(seen)
+
+    data = bytearray()
+    block_offsets = array.array('I')
+    bitmap = bytearray((len(keys) + 7) // 8)
+    previous = b''
+    for i, key in enumerate(keys):
+        if i % BLOCK_SIZE == 0:
+            block_offsets.append(len(data))
+            data += _varint(len(key)) + key
+        else:
+            shared = _shared_prefix(previous, key)
+            data += _varint(shared) + _varint(len(key) - shared) + key[shared:]
+        if seen[key]:
+            bitmap[i // 8] |= 1 << (i % 8)
+        previous = key
+
+    with open(out_file, 'wb') as filehandle:
+        filehandle.write(_HEADER.pack(MAGIC, VERSION, BLOCK_SIZE, len(keys),
+                                      len(block_offsets)))
+        filehandle.write(block_offsets.tobytes())
+        filehandle.write(bytes(bitmap))
+        filehandle.write(bytes(data))
+    return len(keys)
+
+
+class ProperNameIndex(object):
+
+    """
+    Read-only view over a proper-names index file.
+
+    Usage:
+        names = ProperNameIndex(path)
+        names.find('smith')     # -> [('Smith', True)]
+        'smith' in names        # -> True
+        names.prefix('smi')     # -> [('smith', 'Smith', True), ...]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._filehandle = open(path, 'rb')
+        self._map = mmap.mmap(self._filehandle.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        magic, version, self.block_size, self.count, blocks = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a version %d proper-names index'
+                             % (path, VERSION))
+        offset = _HEADER.size
+        self._block_offsets = array.array('I')
+        self._block_offsets.frombytes(self._map[offset:offset + 4 * blocks])
+        offset += 4 * blocks
+        bitmap_length = (self.count + 7) // 8
+        self._bitmap = self._map[offset:offset + bitmap_length]
+        self._data_start = offset + bitmap_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Iterate through all entries, as (sortable, name, is_common)
+        tuples, in sorted order.
+        """
+        for i, key in self._scan(0):
+            yield self._entry(i, key)
+
+    def __contains__(self, sortable):
+        return bool(self.find(sortable))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._filehandle.close()
+
+    def find(self, sortable):
+        """
+        Return a list of (name, is_common) tuples for all the names
+        with the given sortable form.
+        """
+        return [(name, is_common) for _, name, is_common
+                in self._range(sortable.encode('utf8') + _SEPARATOR)]
+
+    def is_common(self, sortable):
+        """
+        Return True if any name with the given sortable form is common;
+        None if there is no such name.
+        """
+        matches = self.find(sortable)
+        if not matches:
+            return None
+        return any(is_common for _, is_common in matches)
+
+    def prefix(self, prefix, limit=None):
+        """
+        Return a list of (sortable, name, is_common) tuples for all the
+        names whose sortable form begins with prefix (up to limit, if
+        given), in sorted order.
+        """
+        matches = []
+        for entry in self._range(prefix.encode('utf8')):
+            if limit is not None and len(matches) >= limit:
+                break
+            matches.append(entry)
+        return matches
+
+    def _range(self, prefix):
+        # Start from the last block whose first key sorts before the
+        #  prefix (any key with the prefix must come at or after it)
+        low, high = 0, len(self._block_offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._first_key(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        start = max(0, low - 1) * self.block_size
+        for i, key in self._scan(start):
+            if key.startswith(prefix):
+                yield self._entry(i, key)
+            elif key > prefix:
+                break
+
+    def _first_key(self, block):
+        position = self._data_start + self._block_offsets[block]
+        length, position = _read_varint(self._map, position)
+        return self._map[position:position + length]
+
+    def _scan(self, start):
+        # Decode keys from entry number start (which must be the first
+        #  entry in a block) to the end of the index
+        if start >= self.count:
+            return
+        position = self._data_start + self._block_offsets[start // self.block_size]
+        key = b''
+        for i in range(start, self.count):
+            if i % self.block_size == 0:
+                length, position = _read_varint(self._map, position)
+                key = self._map[position:position + length]
+                position += length
+            else:
+                shared, position = _read_varint(self._map, position)
+                length, position = _read_varint(self._map, position)
+                key = key[:shared] + self._map[position:position + length]
+                position += length
+            yield i, key
+
+    def _entry(self, i, key):
+        sortable, name = key.split(_SEPARATOR, 1)
+        is_common = bool(self._bitmap[i // 8] & (1 << (i % 8)))
+        return sortable.decode('utf8'), name.decode('utf8'), is_common
+
+
+def _shared_prefix(first, second):
+    limit = min(len(first), len(second))
+    i = 0
+    while i < limit and first[i] == second[i]:
+        i += 1
+    return i
+
+
+def _varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _read_varint(buffer, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
@@ -0,0 +1,298 @@
+"""
+rawblockfile -- compact binary storage for the raw form index
+
+A raw block file holds all the BlockData records for one letter:
+
+    header
+    string table   (uint32 offsets, followed by a UTF-8 string pool)
+    block index    (uint64 absolute offset of each block record)
+    block records
+
+All strings (lemmas, definitions, and the sort/form halves of each
+wordform) are stored once in the string table; block records refer to
+them by integer ID, so each form set is stored as a flat run of
+(sort ID, form ID) pairs. All values are little-endian.
+
+The string table is the letter's build.blockdata.StringTable, as used
+by the indexer for its type sets, so wordform IDs read back from the
+file can be used in the same way (see blocks_with_type_ids()).
+
+RawBlockFile memory-maps the file, so blocks can be read lazily in
+sequence or fetched by position without deserializing the whole file.
+
+@author: James McCracken
+"""
+
+import mmap
+import struct
+from collections import OrderedDict
+
+from build.blockdata import (BlockData, TYPE_FIELDS, wordform_id,
+                             split_wordform_id)
+
+MAGIC = b'TMRB'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIIQQQ')
+_RECORD = struct.Struct('<qqB6Idii3I')
+_OFFSET = struct.Struct('<I')
+_INDEX = struct.Struct('<Q')
+
+_NONE_ID = 0xFFFFFFFF
+
+# Flags marking null values in a block record
+_REFID_NONE = 1
+_FREQUENCY_NONE = 2
+_FREQUENCY_INT = 4
+_START_NONE = 8
+_END_NONE = 16
+
+_STRING_FIELDS = ('type', 'sort', 'lemma', 'wordclass', 'definition',
+                  'language')
+
+
+class RawFormatError(Exception):
+    pass
+
+
+def is_raw_block_file(path):
+    """
+    Return True if the file at path is a raw block file (as opposed
+    to an old-style stream of pickled blocks).
+    """
+    with open(path, 'rb') as filehandle:
+        return filehandle.read(len(MAGIC)) == MAGIC
+
+
+def write_raw_blocks(path, blocks, typesets):
+    """
+    Write a sequence of BlockData records to a raw block file.
+
+    The blocks' type sets are taken from typesets (a
+    build.blockdata.TypeSets, in the same order as the blocks), whose
+    StringTable becomes the file's string table.
+    """
+    strings = typesets.strings
+    records = [_encode_block(block, position, typesets)
+               for position, block in enumerate(blocks)]
+
+    pool = bytearray()
+    string_offsets = bytearray()
+    for value in strings.values:
+        string_offsets += _OFFSET.pack(len(pool))
+        pool += value.encode('utf8')
+    string_offsets += _OFFSET.pack(len(pool))
+
+    strings_offset = _HEADER.size
+    index_offset = strings_offset + len(string_offsets) + len(pool)
+    blocks_offset = index_offset + _INDEX.size * len(records)
+
+    index = bytearray()
+    position = blocks_offset
+    for record in records:
+        index += _INDEX.pack(position)
+        position += len(record)
+
+    with open(path, 'wb') as filehandle:
+        filehandle.write(_HEADER.pack(MAGIC, VERSION, 0, len(records),
+                                      len(strings.values), strings_offset,
+                                      index_offset, blocks_offset))
+        filehandle.write(string_offsets)
+        filehandle.write(pool)
+        filehandle.write(index)
+        for record in records:
+            filehandle.write(record)
+
+
+class RawBlockFile(object):
+
+    """
+    Read-only, memory-mapped view of a raw block file.
+
+    Supports len(), iteration, and indexing by block position; the
+    type sets in each block are returned as sets of (sort, form) tuples.
+
+    Decoded strings are cached: by default every string, for as long
+    as the file is open; if string_cache is given, only that many of
+    the most recently used strings (0 for no caching), so that memory
+    use doesn't grow with the size of the file.
+    """
+
+    def __init__(self, path, string_cache=None):
+        self.path = path
+        self.string_cache = string_cache
+        self._filehandle = open(path, 'rb')
+        self._map = mmap.mmap(self._filehandle.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        (magic, version, _, self.block_count, self.string_count,
+         self._strings_offset, self._index_offset,
+         self._blocks_offset) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise RawFormatError('%s is not a raw block file' % path)
+        if version != VERSION:
+            self.close()
+            raise RawFormatError('%s: unsupported version %d' % (path, version))
+        self._pool_offset = (self._strings_offset +
+                             _OFFSET.size * (self.string_count + 1))
+        if string_cache is None:
+            self._strings = [None] * self.string_count
+        else:
+            self._strings = OrderedDict()
+
+    def __len__(self):
+        return self.block_count
+
+    def __iter__(self):
+        for i in range(self.block_count):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.block_count
+        if not 0 <= i < self.block_count:
+            raise IndexError('block index out of range')
+        block, typesets = self._decode_record(self._block_offset(i))
+        return block._replace(**{field: set(map(self._wordform, typeset))
+                                 for field, typeset in zip(TYPE_FIELDS,
+                                                           typesets)})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def blocks_with_type_ids(self):
+        """
+        Iterate through the blocks, with each type set given as a list
+        of wordform IDs (over this file's string table) rather than
+        decoded, e.g. for adding to a build.blockdata.TypeSets with
+        this file as its strings.
+        """
+        for i in range(self.block_count):
+            block, typesets = self._decode_record(self._block_offset(i))
+            yield block._replace(**dict(zip(TYPE_FIELDS, typesets)))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._filehandle.close()
+
+    def string(self, string_id):
+        """
+        Return the string with the given ID from the string table.
+        """
+        if string_id == _NONE_ID:
+            return None
+        if self.string_cache is None:
+            value = self._strings[string_id]
+            if value is None:
+                value = self._read_string(string_id)
+                self._strings[string_id] = value
+            return value
+
+        # Bounded cache: least recently used strings are dropped first
+        try:
+            value = self._strings[string_id]
+        except KeyError:
+            value = self._read_string(string_id)
+            if self.string_cache:
+                self._strings[string_id] = value
+                if len(self._strings) > self.string_cache:
+                    self._strings.popitem(last=False)
+        else:
+            self._strings.move_to_end(string_id)
+        return value
+
+    def _read_string(self, string_id):
+        start, end = struct.unpack_from(
+            '<2I', self._map, self._strings_offset + _OFFSET.size * string_id)
+        return self._map[self._pool_offset + start:
+                         self._pool_offset + end].decode('utf8')
+
+    def _block_offset(self, i):
+        return _INDEX.unpack_from(self._map,
+                                  self._index_offset + _INDEX.size * i)[0]
+
+    def _wordform(self, packed_id):
+        sort_id, form_id = split_wordform_id(packed_id)
+        return self.string(sort_id), self.string(form_id)
+
+    def _decode_record(self, offset):
+        """
+        Return the block at offset (with its type fields empty), and
+        its three type sets as lists of wordform IDs.
+        """
+        fields = _RECORD.unpack_from(self._map, offset)
+        refentry, refid, flags = fields[0:3]
+        values = {name: self.string(string_id) for name, string_id
+                  in zip(_STRING_FIELDS, fields[3:9])}
+        frequency, start, end = fields[9:12]
+        counts = fields[12:15]
+
+        if flags & _REFID_NONE:
+            refid = None
+        if flags & _FREQUENCY_NONE:
+            frequency = None
+        elif flags & _FREQUENCY_INT:
+            frequency = int(frequency)
+        if flags & _START_NONE:
+            start = None
+        if flags & _END_NONE:
+            end = None
+
+        ids = struct.unpack_from('<%dI' % (2 * sum(counts)), self._map,
+                                 offset + _RECORD.size)
+        typesets = []
+        position = 0
+        for count in counts:
+            typesets.append([wordform_id(ids[j], ids[j + 1]) for j
+                             in range(position, position + 2 * count, 2)])
+            position += 2 * count
+
+        block = BlockData(refentry, refid, values['type'], values['sort'],
+                          values['lemma'], values['wordclass'],
+                          values['definition'], frequency, start, end,
+                          values['language'], None, None, None)
+        return block, typesets
+
+
+def _encode_block(block, position, typesets):
+    flags = 0
+    refid = block.refid
+    if refid is None:
+        flags |= _REFID_NONE
+        refid = 0
+    frequency = block.frequency
+    if frequency is None:
+        flags |= _FREQUENCY_NONE
+        frequency = 0.0
+    elif isinstance(frequency, int):
+        flags |= _FREQUENCY_INT
+    start, end = block.start, block.end
+    if start is None:
+        flags |= _START_NONE
+        start = 0
+    if end is None:
+        flags |= _END_NONE
+        end = 0
+
+    strings = typesets.strings
+    ids = []
+    counts = []
+    for kind in range(len(TYPE_FIELDS)):
+        wordform_ids = typesets.ids(position, kind)
+        for packed_id in wordform_ids:
+            ids.extend(split_wordform_id(packed_id))
+        counts.append(len(wordform_ids))
+
+    string_ids = []
+    for name in _STRING_FIELDS:
+        value = getattr(block, name)
+        string_ids.append(_NONE_ID if value is None else strings.id(value))
+
+    record = _RECORD.pack(block.refentry, refid, flags, *string_ids,
+                          frequency, start, end, *counts)
+    return record + struct.pack('<%dI' % len(ids), *ids)
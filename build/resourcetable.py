@@ -0,0 +1,101 @@
+"""
+ResourceTable -- batch-resolved lex-resource lookups for a letter
+
+Rather than probing VitalStatisticsCache and MainSensesCache once per
+block while refining, all the keys needed for a letter are collected
+up front and resolved in a single sweep, in sorted key order. The
+results are held in a compact table (sorted key arrays, with parallel
+lists of values), which the refine loop then reads from.
+
+@author: James McCracken
+"""
+
+import sys
+import array
+import bisect
+
+
+class ResourceTable(object):
+
+    def __init__(self):
+        self._entry_keys = array.array('q')
+        self._languages = []
+        self._headwords = []
+        self._sense_keys = array.array('q')
+        self._definitions = []
+
+    @classmethod
+    def build(cls, entry_keys, sense_keys, vitalstats, main_sense_checker):
+        """
+        Resolve lookups for a letter.
+
+        entry_keys: refentry IDs for which language and headword are
+            needed;
+        sense_keys: (refentry, refid) pairs for which the main-sense
+            definition is needed.
+        """
+        table = cls()
+        # (keys may be given as generators, so each is read only once)
+        sense_keys = set(sense_keys)
+        headword_keys = set(refentry for refentry, _ in sense_keys)
+        for refentry in sorted(set(entry_keys)):
+            table._entry_keys.append(refentry)
+            language = vitalstats.find(refentry, field='indirect_language')
+            table._languages.append(_intern(language))
+            if refentry in headword_keys:
+                table._headwords.append(vitalstats.find(refentry,
+                                                        field='headword'))
+            else:
+                table._headwords.append(None)
+        for refentry, refid in sorted(sense_keys, key=_sense_key):
+            table._sense_keys.append(_sense_key((refentry, refid)))
+            main_sense = main_sense_checker.find_main_sense_data(refentry,
+                                                                 refid)
+            table._definitions.append(main_sense.definition if main_sense
+                                      else None)
+        return table
+
+    @classmethod
+    def for_blocks(cls, blocks, vitalstats, main_sense_checker):
+        """
+        Build a table covering a list of blocks: the language for every
+        block, and the headword and main-sense definition for each
+        block of type 'entry'.
+        """
+        return cls.build([b.refentry for b in blocks],
+                         [(b.refentry, b.refid) for b in blocks
+                          if b.type == 'entry'],
+                         vitalstats, main_sense_checker)
+
+    def __len__(self):
+        return len(self._entry_keys)
+
+    def language(self, refentry):
+        i = _find(self._entry_keys, refentry)
+        return self._languages[i] if i is not None else None
+
+    def headword(self, refentry):
+        i = _find(self._entry_keys, refentry)
+        return self._headwords[i] if i is not None else None
+
+    def main_sense_definition(self, refentry, refid):
+        i = _find(self._sense_keys, _sense_key((refentry, refid)))
+        return self._definitions[i] if i is not None else None
+
+
+def _find(keys, key):
+    i = bisect.bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        return i
+    return None
+
+
+def _sense_key(pair):
+    # Pack (refentry, refid) into a single 64-bit sort key; a null refid
+    #  is stored as 0, so real refids are shifted up by 1
+    refentry, refid = pair
+    return (refentry << 32) | (0 if refid is None else refid + 1)
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
@@ -0,0 +1,275 @@
+"""
+instrumentation -- timings and counters for pipeline runs
+
+A RunReport records, for each stage and each letter within a stage:
+wall-clock time, CPU time (including any worker processes), RSS at the
+start and end and its peak in between, and named counters (entries scanned, blocks emitted, DB rows written,
+lex-resource lookups, etc.). The report is written out as JSON at the
+end of a run; optionally, one stage can also be run under cProfile.
+
+Build code reports counts through the module-level count() and
+record() functions, which apply to the innermost active measurement
+(and do nothing if there is none), so that the indexers don't need
+to have a report passed around.
+
+The peak RSS of each measurement is found by resetting the kernel's
+high-water mark (VmHWM) at the start, which needs Linux; elsewhere,
+only the process's peak so far is available, and this is reported as
+'run_peak_rss_kb' rather than 'peak_rss_kb', since it may come from
+an earlier stage.
+
+@author: James McCracken
+"""
+
+import os
+import json
+import time
+import itertools
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_ACTIVE = []
+# Numbers the RunReports created by this process
+_RUN_NUMBERS = itertools.count(1)
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+class Measurement(object):
+
+    """
+    Timings and counters for a single stage or letter.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.values = {}
+        self.letters = {}
+        self.stats = {}
+
+    def start(self):
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+        self._rss = _current_rss()
+        # Resetting the high-water mark would lose the peak so far of
+        #  any enclosing measurement, so fold it into theirs first
+        high_water = _high_water_mark()
+        for measurement in _ACTIVE:
+            measurement._peak = max(measurement._peak, high_water or 0)
+        self._peak = 0
+        self._peak_reset = _reset_high_water_mark()
+        _ACTIVE.append(self)
+
+    def stop(self):
+        _ACTIVE.remove(self)
+        self.stats = {
+            'wall_seconds': round(time.perf_counter() - self._wall, 3),
+            'cpu_seconds': round(_cpu_time() - self._cpu, 3),
+            'rss_start_kb': self._rss,
+            'rss_end_kb': _current_rss(),
+        }
+        if self._peak_reset:
+            peak = max(self._peak, _high_water_mark() or 0)
+            # Letters processed by worker processes report their own
+            #  peaks; the largest of these is the stage's peak, if it's
+            #  higher than this process's
+            for data in self.letters.values():
+                peak = max(peak, data.get('peak_rss_kb') or 0)
+            self.stats['peak_rss_kb'] = peak
+        else:
+            self.stats['run_peak_rss_kb'] = _run_peak_rss()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_letter(self, letter, data):
+        """
+        Add the measurements for a letter (as returned by as_dict(),
+        e.g. from a worker process), and roll its counters up into
+        this measurement.
+        """
+        self.letters[letter] = data
+        for name, n in data.get('counters', {}).items():
+            self.count(name, n)
+
+    def as_dict(self):
+        data = dict(self.stats)
+        data['counters'] = dict(self.counters)
+        if self.values:
+            data['values'] = dict(self.values)
+        if self.letters:
+            data['letters'] = self.letters
+        return data
+
+
+class RunReport(object):
+
+    def __init__(self, profile_stage=None, out_dir=None):
+        self.profile_stage = profile_stage
+        self.out_dir = out_dir
+        self.started = time.strftime('%Y%m%d-%H%M%S')
+        # Runs started in the same second (in different processes, or
+        #  one after another in the same process) mustn't overwrite
+        #  each other's output files
+        self.run_id = '%s-%d-%d' % (self.started, os.getpid(),
+                                    next(_RUN_NUMBERS))
+        self.stages = []
+        # Import and resource-initialization times (see resources.py)
+        self.startup = {}
+
+    @contextmanager
+    def stage(self, name):
+        measurement = Measurement(name)
+        self.stages.append(measurement)
+        profiler = None
+        if self.profile_stage == name:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        measurement.start()
+        try:
+            yield measurement
+        finally:
+            measurement.stop()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self._out_file('%s.prof' % name))
+
+    def as_dict(self):
+        return {'started': self.started,
+                'startup': self.startup,
+                'stages': {m.name: m.as_dict() for m in self.stages}}
+
+    def write(self):
+        out_file = self._out_file('report.json')
+        with open(out_file, 'w') as filehandle:
+            json.dump(self.as_dict(), filehandle, indent=2, sort_keys=True)
+        return out_file
+
+    def _out_file(self, suffix):
+        out_dir = self.out_dir or '.'
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        return os.path.join(out_dir, 'run-%s-%s' % (self.run_id, suffix))
+
+
+@contextmanager
+def measure(name):
+    """
+    Measure a block of code (e.g. a single letter) as a standalone
+    Measurement. This works the same in a worker process, where the
+    result can be passed back to the parent with as_dict().
+    """
+    measurement = Measurement(name)
+    measurement.start()
+    try:
+        yield measurement
+    finally:
+        measurement.stop()
+
+
+def count(name, n=1):
+    """
+    Increment a counter on the innermost active measurement.
+    """
+    if _ACTIVE:
+        _ACTIVE[-1].count(name, n)
+
+
+def record(name, value):
+    """
+    Record a named value (e.g. a cache hit rate) on the innermost
+    active measurement.
+    """
+    if _ACTIVE:
+        _ACTIVE[-1].values[name] = value
+
+
+def add_letter(letter, data):
+    """
+    Attach a letter's measurements to the innermost active measurement.
+    """
+    if _ACTIVE:
+        _ACTIVE[-1].add_letter(letter, data)
+
+
+class CountingProxy(object):
+
+    """
+    Wraps a resource (e.g. a VitalStatisticsCache), counting calls to
+    its methods as '<prefix>.<method>'.
+    """
+
+    def __init__(self, target, prefix):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        counter_name = '%s.%s' % (self._prefix, name)
+
+        def counted(*args, **kwargs):
+            count(counter_name)
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def _cpu_time():
+    if resource is None:
+        return time.process_time()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage_self.ru_utime + usage_self.ru_stime +
+            usage_children.ru_utime + usage_children.ru_stime)
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as filehandle:
+            pages = int(filehandle.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * _PAGE_SIZE // 1024
+
+
+def _high_water_mark():
+    # Peak RSS (in kB) since the process started, or since the
+    #  high-water mark was last reset
+    try:
+        with open('/proc/self/status') as filehandle:
+            for line in filehandle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_high_water_mark():
+    # Writing '5' to clear_refs resets VmHWM to the current RSS
+    #  (Linux 4.0+); returns False if this isn't possible
+    if _high_water_mark() is None:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as filehandle:
+            filehandle.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _run_peak_rss():
+    # Peak RSS of the run so far (not of any one measurement)
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
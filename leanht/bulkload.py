@@ -0,0 +1,134 @@
+"""
+BulkLoader -- streams rows into a database table in bulk.
+
+Uses PostgreSQL's COPY FROM STDIN when the engine supports it, and
+otherwise falls back to batched executemany() inserts through
+SQLAlchemy Core (so that e.g. SQLite can be used for local testing).
+
+@author: James McCracken
+"""
+
+import io
+import time
+
+import instrumentation
+
+
+class BulkLoader(object):
+
+    """
+    Buffers rows (as dicts keyed by column name) and writes them to
+    the table in batches.
+
+    Usage:
+        loader = BulkLoader(engine, ThesInstance.__table__)
+        for row in rows:
+            loader.add(row)
+        loader.close()
+        print(loader.report())
+    """
+
+    def __init__(self, engine, table, batch_size=10000):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.columns = [column.name for column in table.columns]
+        self.use_copy = _supports_copy(engine)
+        self.rows = 0
+        self.elapsed = 0.0
+        self._buffer = []
+
+    def add(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        start = time.perf_counter()
+        if self.use_copy:
+            self._copy(self._buffer)
+        else:
+            with self.engine.begin() as connection:
+                connection.execute(self.table.insert(), self._buffer)
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(self._buffer)
+        instrumentation.count('db_rows.' + self.table.name, len(self._buffer))
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        instrumentation.record('db_rows_per_second.' + self.table.name,
+                               round(self.rate(), 1))
+
+    def rate(self):
+        """
+        Return the number of rows written per second of database time.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    def report(self):
+        return '%s: %d rows in %.1fs (%.0f rows/sec, %s)' % (
+            self.table.name, self.rows, self.elapsed, self.rate(),
+            'COPY' if self.use_copy else 'executemany')
+
+    def _copy(self, rows):
+        # Only the columns that the rows supply (so that e.g. a serial
+        #  primary key left out of the rows gets its default)
+        columns = [column for column in self.columns if column in rows[0]]
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join([_copy_value(row.get(column))
+                                    for column in columns]))
+            buffer.write('\n')
+        buffer.seek(0)
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+                self.table.name, ', '.join(columns)), buffer)
+            cursor.close()
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def recreate_table(engine, table):
+    """
+    Drop and recreate the table, then drop its secondary indexes
+    so that they can be built once, after a bulk load (using
+    create_indexes()).
+    """
+    table.drop(engine, checkfirst=True)
+    table.create(engine, checkfirst=True)
+    for index in table.indexes:
+        index.drop(engine)
+
+
+def create_indexes(engine, table):
+    for index in table.indexes:
+        index.create(engine)
+
+
+def _supports_copy(engine):
+    if engine.dialect.name != 'postgresql':
+        return False
+    connection = engine.raw_connection()
+    try:
+        return hasattr(connection.cursor(), 'copy_expert')
+    finally:
+        connection.close()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
@@ -0,0 +1,164 @@
+"""
+ThesaurusLookup -- batched lemma/sense lookups against the HT-lean tables
+
+Resolves many lemmas (or refentry/refid pairs) to ThesInstance rows in
+a couple of round trips: one query for the instances (with their
+classes joined in), and one for all the classes' ancestors (found from
+the classes' materialized paths). Each class's ancestor list is filled
+in from the second query, so breadcrumbs need no further queries.
+
+Results are held in a bounded LRU cache, so lemmas that recur across
+documents aren't looked up again.
+
+@author: James McCracken
+"""
+
+from collections import OrderedDict
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+
+import textmetricsconfig
+import instrumentation
+from leanht.models import ThesClass, ThesInstance
+from leanht.taxonomyindex import path_ids
+
+CACHE_SIZE = textmetricsconfig.THESAURUS_LOOKUP_CACHE_SIZE
+# Maximum number of values in a single IN (...) clause
+CHUNK_SIZE = 500
+
+
+class ThesaurusLookup(object):
+
+    """
+    Usage:
+        lookup = ThesaurusLookup(session)
+        results = lookup.lemmas(['scimitar', 'sabre'])
+        for instance in results['scimitar']:
+            print(instance.breadcrumb())
+
+    Cached instances stay attached to the session; call clear() after
+    committing changes to the tables (or if the session is replaced).
+    """
+
+    def __init__(self, session=None, cache_size=CACHE_SIZE):
+        self.session = session or textmetricsconfig.SESSION
+        self._cache = _LRUCache(cache_size)
+
+    def lemma(self, lemma):
+        return self.lemmas([lemma])[lemma]
+
+    def sense(self, refentry, refid):
+        return self.senses([(refentry, refid)])[(refentry, refid)]
+
+    def lemmas(self, lemmas):
+        """
+        Return a dict mapping each lemma to the list of ThesInstances
+        with that lemma.
+        """
+        lemmas = list(lemmas)
+        return self._lookup(
+            'lemma', lemmas, [lemma[0:100] for lemma in lemmas],
+            lambda keys: ThesInstance.lemma.in_(keys),
+            lambda instance: instance.lemma)
+
+    def senses(self, pairs):
+        """
+        Return a dict mapping each (refentry, refid) pair to the list of
+        ThesInstances for that sense.
+        """
+        pairs = [(int(refentry), int(refid)) for refentry, refid in pairs]
+        return self._lookup(
+            'sense', pairs, pairs,
+            lambda keys: tuple_(ThesInstance.refentry,
+                                ThesInstance.refid).in_(keys),
+            lambda instance: (instance.refentry, instance.refid))
+
+    def clear(self):
+        self._cache.clear()
+
+    def _lookup(self, kind, requested, query_keys, condition, instance_key):
+        # query_keys are the requested keys as they're stored in the
+        #  table (and in the cache)
+        results = {}
+        missing = {}
+        for key, query_key in zip(requested, query_keys):
+            cached = self._cache.get((kind, query_key))
+            if cached is not None:
+                results[key] = cached
+            else:
+                missing.setdefault(query_key, []).append(key)
+        instrumentation.count('thesaurus_lookup.hits', len(results))
+        instrumentation.count('thesaurus_lookup.misses', len(missing))
+        if not missing:
+            return results
+
+        found = {query_key: [] for query_key in missing}
+        keys = sorted(missing)
+        for i in range(0, len(keys), CHUNK_SIZE):
+            instances = self.session.query(ThesInstance).\
+                options(joinedload(ThesInstance.thesclass)).\
+                filter(condition(keys[i:i + CHUNK_SIZE])).\
+                order_by(ThesInstance.id).all()
+            for instance in instances:
+                found[instance_key(instance)].append(instance)
+        self._load_ancestors([instance.thesclass for instance_list
+                              in found.values() for instance in instance_list
+                              if instance.thesclass is not None])
+
+        for query_key, instances in found.items():
+            self._cache.put((kind, query_key), instances)
+            for key in missing[query_key]:
+                results[key] = instances
+        return results
+
+    def _load_ancestors(self, classes):
+        """
+        Fetch the ancestors of all the given classes in a single query
+        (per chunk of IDs), and fill in each class's ancestor list.
+        Classes without a materialized path are left to load their
+        ancestors lazily.
+        """
+        loaded = {thesclass.id: thesclass for thesclass in classes}
+        classes = [thesclass for thesclass in loaded.values()
+                   if thesclass.path and '_ancestors' not in thesclass.__dict__]
+        wanted = set()
+        for thesclass in classes:
+            wanted.update(path_ids(thesclass.path))
+        wanted = sorted(wanted - set(loaded))
+        for i in range(0, len(wanted), CHUNK_SIZE):
+            for ancestor in self.session.query(ThesClass).\
+                    filter(ThesClass.id.in_(wanted[i:i + CHUNK_SIZE])):
+                loaded[ancestor.id] = ancestor
+        for thesclass in classes:
+            id_list = path_ids(thesclass.path)
+            if all(class_id in loaded for class_id in id_list):
+                thesclass._ancestors = [loaded[class_id] for class_id
+                                        in reversed(id_list)]
+
+
+class _LRUCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
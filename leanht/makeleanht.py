@@ -1,86 +1,208 @@
 
+import os
 import re
+import shutil
+import tempfile
+import functools
+import multiprocessing
 
 from lex.oed.thesaurus.contentiterator import ContentIterator
 from lex.oed.resources.mainsenses import MainSensesCache
 import textmetricsconfig
+import instrumentation
+import resources
+from instrumentation import CountingProxy
 
-MAIN_SENSE_CHECKER = MainSensesCache()
+# Main-senses cache, created on first use rather than at import
+resources.register('main_sense_checker',
+                   lambda: CountingProxy(MainSensesCache(), 'mainsenses'))
 OUT_DIR = textmetricsconfig.LEANHT_DIR
-
-
-def make_lean_ht():
-    iterator = ContentIterator(out_dir=OUT_DIR, yield_mode='file')
-    for classes in iterator.iterate():
-        # Build a map of each class indexed by ID
-        classmap = {thesclass.id(): thesclass for thesclass in classes}
-        # Set of IDs marking classes which will be dropped
-        dropped_classes = set()
-
-        # Drop instances that represent minor senses
-        for thesclass in classes:
-            if thesclass.instances():
-                wordclass = thesclass.wordclass(penn=True)
-                stripnodes = []
-                for instance in thesclass.instances():
-                    minor_sense, minor_homograph = _test_status(instance, wordclass)
-                    if minor_sense or minor_homograph:
-                        stripnodes.append(instance.node)
-                if stripnodes:
-                    container = stripnodes[0].getparent()
-                    for node in stripnodes:
-                        container.remove(node)
-                    # Reset the listed size of the class
-                    new_size = thesclass.size() - len(stripnodes)
-                    if thesclass.size() == thesclass.size(branch=True):
-                        thesclass.reset_size(new_size, branch=True)
-                    thesclass.reset_size(new_size)
-                    if thesclass.size(branch=True) == 0:
-                        dropped_classes.add(thesclass.id())
-
-        # Roll up minor leaf nodes to the parent node
-        for thesclass in [c for c in classes if not c.id() in dropped_classes]:
-            thesclass.reload_instances()
-            parentclass = classmap.get(thesclass.parent(), None)
-            if _viable_for_rollup(thesclass, parentclass):
-                # Move instances from this class to the parent class
-                for instance in thesclass.instances():
-                    parentclass.node.append(instance.node)
-                # Mark this class to be dropped
-                dropped_classes.add(thesclass.id())
-                print('-----------------------------------------')
-                print(thesclass.id(), thesclass.breadcrumb())
-                print('->', parentclass.id(), parentclass.breadcrumb())
-
-        # Remove child-node pointers for nodes which are about to be deleted
-        for thesclass in [c for c in classes if not c.id() in dropped_classes]:
-            for child_id in thesclass.child_nodes():
-                if child_id in dropped_classes:
-                    thesclass.remove_child(child_id)
-
-        # Remove nodes for classes marked to be dropped
-        for classid in dropped_classes:
-            thesclass = classmap[classid]
-            thesclass.node.getparent().remove(thesclass.node)
-
-        # Redo counts in the remaining classes
-        for thesclass in [c for c in classes if not c.id() in dropped_classes]:
-            thesclass.reload_instances()
-            thesclass.reset_size(len(thesclass.instances()))
+HT_CONTENT_DIR = textmetricsconfig.HT_CONTENT_DIR
+LEANHT_PROCESSES = textmetricsconfig.LEANHT_PROCESSES
+MINOR_STATUS_CACHE_SIZE = textmetricsconfig.MINOR_STATUS_CACHE_SIZE
+
+
+def make_lean_ht(processes=None):
+    """
+    Strip minor senses from the HT, and roll up minor leaf classes,
+    writing the result to LEANHT_DIR.
+
+    If processes > 1 (and HT_CONTENT_DIR is set), the HT files are
+    divided between a pool of worker processes.
+    """
+    if processes is None:
+        processes = LEANHT_PROCESSES
+    _is_minor_sense.cache_clear()
+    _is_minor_homograph.cache_clear()
+    # Load the main-senses cache before forking any workers, so that
+    #  they share it rather than each loading their own
+    resources.get('main_sense_checker')
+
+    if processes > 1 and HT_CONTENT_DIR:
+        shard_dir = tempfile.mkdtemp(prefix='leanht')
+        try:
+            shards = _make_shards(HT_CONTENT_DIR, shard_dir, processes)
+            with multiprocessing.Pool(processes=len(shards)) as pool:
+                results = pool.map(_process_shard, shards, chunksize=1)
+        finally:
+            shutil.rmtree(shard_dir)
+    else:
+        if processes > 1:
+            print('HT_CONTENT_DIR is not set; running in a single process')
+        results = [_process_files(ContentIterator(out_dir=OUT_DIR,
+                                                  yield_mode='file'))]
+
+    for counters in results:
+        for name, n in counters.items():
+            instrumentation.count(name, n)
+    lookups = sum(counters['minor_status.lookups'] for counters in results)
+    hits = sum(counters['minor_status.hits'] for counters in results)
+    if lookups:
+        instrumentation.record('minor_status.hit_rate', round(hits / lookups, 3))
+        print('Minor-status cache: %d lookups, %.1f%% hits' %
+              (lookups, 100 * hits / lookups))
+
+
+def _make_shards(in_dir, shard_dir, count):
+    """
+    Divide the files in in_dir between a number of shard directories,
+    populated with symlinks to the original files; each shard can then
+    be processed by its own ContentIterator.
+    """
+    filenames = sorted(f for f in os.listdir(in_dir)
+                       if os.path.isfile(os.path.join(in_dir, f)))
+    count = max(1, min(count, len(filenames)))
+    shards = [os.path.join(shard_dir, str(i)) for i in range(count)]
+    for shard in shards:
+        os.makedirs(shard)
+    for i, filename in enumerate(filenames):
+        os.symlink(os.path.join(in_dir, filename),
+                   os.path.join(shards[i % count], filename))
+    return shards
+
+
+def _process_shard(shard):
+    return _process_files(ContentIterator(path=shard, out_dir=OUT_DIR,
+                                          yield_mode='file'))
+
+
+def _process_files(iterator):
+    """
+    Process each file yielded by the ContentIterator; returns a dict of
+    counters (so that they can be passed back from a worker process).
+    """
+    # cache_info() is cumulative over the life of the process (and a
+    #  worker may process more than one shard), so only the difference
+    #  made by these files is reported
+    before = _minor_status_info()
+    with instrumentation.measure('files') as measurement:
+        for classes in iterator.iterate():
+            _process_file(classes)
+    after = _minor_status_info()
+    counters = dict(measurement.counters)
+    counters['minor_status.lookups'] = after[0] - before[0]
+    counters['minor_status.hits'] = after[1] - before[1]
+    return counters
+
+
+def _minor_status_info():
+    # Total (lookups, hits) so far for the memoized minor-status checks
+    lookups = 0
+    hits = 0
+    for function in (_is_minor_sense, _is_minor_homograph):
+        info = function.cache_info()
+        lookups += info.hits + info.misses
+        hits += info.hits
+    return lookups, hits
+
+
+def _process_file(classes):
+    instrumentation.count('files')
+    instrumentation.count('classes', len(classes))
+    # Build a map of each class indexed by ID
+    classmap = {thesclass.id(): thesclass for thesclass in classes}
+    # Set of IDs marking classes which will be dropped
+    dropped_classes = set()
+
+    # Drop instances that represent minor senses
+    for thesclass in classes:
+        if thesclass.instances():
+            wordclass = thesclass.wordclass(penn=True)
+            stripnodes = []
+            for instance in thesclass.instances():
+                minor_sense, minor_homograph = _test_status(instance, wordclass)
+                if minor_sense or minor_homograph:
+                    stripnodes.append(instance.node)
+            if stripnodes:
+                container = stripnodes[0].getparent()
+                for node in stripnodes:
+                    container.remove(node)
+                # Reset the listed size of the class
+                new_size = thesclass.size() - len(stripnodes)
+                if thesclass.size() == thesclass.size(branch=True):
+                    thesclass.reset_size(new_size, branch=True)
+                thesclass.reset_size(new_size)
+                if thesclass.size(branch=True) == 0:
+                    dropped_classes.add(thesclass.id())
+
+    # Roll up minor leaf nodes to the parent node
+    for thesclass in [c for c in classes if not c.id() in dropped_classes]:
+        thesclass.reload_instances()
+        parentclass = classmap.get(thesclass.parent(), None)
+        if _viable_for_rollup(thesclass, parentclass):
+            # Move instances from this class to the parent class
+            for instance in thesclass.instances():
+                parentclass.node.append(instance.node)
+            # Mark this class to be dropped
+            dropped_classes.add(thesclass.id())
+            print('-----------------------------------------')
+            print(thesclass.id(), thesclass.breadcrumb())
+            print('->', parentclass.id(), parentclass.breadcrumb())
+
+    # Remove child-node pointers for nodes which are about to be deleted
+    for thesclass in [c for c in classes if not c.id() in dropped_classes]:
+        for child_id in thesclass.child_nodes():
+            if child_id in dropped_classes:
+                thesclass.remove_child(child_id)
+
+    # Remove nodes for classes marked to be dropped
+    for classid in dropped_classes:
+        thesclass = classmap[classid]
+        thesclass.node.getparent().remove(thesclass.node)
+
+    # Redo counts in the remaining classes
+    for thesclass in [c for c in classes if not c.id() in dropped_classes]:
+        thesclass.reload_instances()
+        thesclass.reset_size(len(thesclass.instances()))
 
 
 def _test_status(instance, wordclass):
-    is_minor_sense = MAIN_SENSE_CHECKER.is_minor_sense(
+    is_minor_sense = _is_minor_sense(
         instance.refentry(),
         instance.refid(),
         instance.lemma(),)
-    is_minor_homograph = MAIN_SENSE_CHECKER.is_in_minor_homograph(
+    is_minor_homograph = _is_minor_homograph(
         instance.refentry(),
         instance.lemma(),
         wordclass,)
     return is_minor_sense, is_minor_homograph
 
 
+# The same (refentry, lemma, wordclass) lookups recur many times across
+#  the HT, so results are memoized (per process)
+
+@functools.lru_cache(maxsize=MINOR_STATUS_CACHE_SIZE)
+def _is_minor_sense(refentry, refid, lemma):
+    return resources.get('main_sense_checker').is_minor_sense(
+        refentry, refid, lemma)
+
+
+@functools.lru_cache(maxsize=MINOR_STATUS_CACHE_SIZE)
+def _is_minor_homograph(refentry, lemma, wordclass):
+    return resources.get('main_sense_checker').is_in_minor_homograph(
+        refentry, lemma, wordclass)
+
+
 def _viable_for_rollup(thesclass, parentclass):
     if (thesclass.is_leaf_node() and
             thesclass.size() <= 2 and
@@ -6,13 +6,16 @@ ThesInstance
 """
 
 import re
+import hashlib
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
+from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.dialects import mysql as sa_mysql
 
+from leanht.taxonomyindex import path_ids, PATH_SEPARATOR
+
 Base = declarative_base()
 
 
@@ -25,21 +28,69 @@ class ThesClass(Base):
     wordclass = Column(String(20))
     node_size = Column(Integer, nullable=False)
     branch_size = Column(Integer, nullable=False)
+    # Materialized ancestor path (see leanht.taxonomyindex)
+    path = Column(String(255))
+    # Hash of the class's own columns plus its instances (see
+    #  compute_hash()), used to detect changed classes in a delta load
+    content_hash = Column(String(40))
 
     parent_id = Column(Integer, ForeignKey('tm_thesaurusclass.id'))
     children = relationship('ThesClass',
                             backref=backref('parent', remote_side=[id]))
 
+    # Descendant queries match on a path prefix (see descendants());
+    #  PostgreSQL only uses an index for LIKE 'prefix%' with pattern ops
+    __table_args__ = (Index('ix_tm_thesaurusclass_path', 'path',
+                            postgresql_ops={'path': 'varchar_pattern_ops'}),)
+
     def __init__(self, thesaurus_class, **kwargs):
-        self.id = thesaurus_class.id()
-        self.label = thesaurus_class.label() or None
-        self.level = thesaurus_class.level()
-        self.wordclass = thesaurus_class.wordclass(penn=True)
-        self.node_size = kwargs.get('size') or thesaurus_class.size(branch=False)
-        self.branch_size = thesaurus_class.size(branch=True)
-        self.parent_id = thesaurus_class.parent()
-        if self.label is not None:
-            self.label = self.label[0:200]
+        for key, value in self.row_data(thesaurus_class, **kwargs).items():
+            setattr(self, key, value)
+
+    @staticmethod
+    def row_data(thesaurus_class, **kwargs):
+        """
+        Return the column values for a thesaurus class as a dict
+        (as used when bulk-loading the table).
+
+        Keyword 'index' may give the class's (lft, rgt, path) tuple,
+        as computed by leanht.taxonomyindex.taxonomy_index(); only the
+        path is stored.
+        """
+        label = thesaurus_class.label() or None
+        if label is not None:
+            label = label[0:200]
+        _, _, path = kwargs.get('index') or (None, None, None)
+        return {
+            'id': thesaurus_class.id(),
+            'label': label,
+            'level': thesaurus_class.level(),
+            'wordclass': thesaurus_class.wordclass(penn=True),
+            'node_size': kwargs.get('size') or thesaurus_class.size(branch=False),
+            'branch_size': thesaurus_class.size(branch=True),
+            'parent_id': thesaurus_class.parent(),
+            'path': path,
+            'content_hash': None,
+        }
+
+    @staticmethod
+    def compute_hash(class_row, instance_rows):
+        """
+        Return a hash of a class's row data and its instances' row data
+        (as returned by row_data()).
+
+        The path is left out, since this changes for a whole subtree
+        whenever a class is moved to a new parent; instance order is
+        ignored.
+        """
+        values = [repr(class_row.get(column)) for column in
+                  ('id', 'label', 'level', 'wordclass', 'node_size',
+                   'branch_size', 'parent_id')]
+        values.extend(sorted(repr((row.get('lemma'), row.get('refentry'),
+                                   row.get('refid'), row.get('start_year'),
+                                   row.get('end_year')))
+                             for row in instance_rows))
+        return hashlib.sha1('\n'.join(values).encode('utf8')).hexdigest()
 
     def __repr__(self):
         return '<ThesClass %d (%s)>' % (self.id, self.signature())
@@ -91,11 +142,24 @@ class ThesClass(Base):
         beginning with self.
 
         Note that that the present class is included as the first element
-        of the list
+        of the list.
+
+        If the class has a materialized path, all the ancestors are
+        fetched in a single query.
         """
         try:
             return self._ancestors
         except AttributeError:
+            pass
+        session = object_session(self)
+        if self.path and session is not None:
+            id_list = self.ancestor_id_list()
+            ancestors = session.query(ThesClass).\
+                filter(ThesClass.id.in_(id_list)).all()
+            ancestors.sort(key=lambda a: id_list.index(a.id), reverse=True)
+            self._ancestors = ancestors
+            return self._ancestors
+        else:
             self._ancestors = [self, ]
             if self.parent is not None:
                 parent = self.parent
@@ -117,8 +181,17 @@ class ThesClass(Base):
             self._ancestors_descending = list(reversed(self.ancestors()))
             return self._ancestors_descending
 
+    def ancestor_id_list(self):
+        """
+        Return the IDs of ancestor classes, in descending order
+        (i.e. beginning with the root class and ending with self).
+        """
+        if self.path:
+            return path_ids(self.path)
+        return [a.id for a in reversed(self.ancestors())]
+
     def ancestor_ids(self):
-        return set([a.id for a in self.ancestors()])
+        return set(self.ancestor_id_list())
 
     def ancestor(self, level=1):
         """
@@ -143,15 +216,27 @@ class ThesClass(Base):
         if isinstance(class_id, ThesClass):
             class_id = class_id.id
         class_id = int(class_id)
-        if class_id in [a.id for a in self.ancestors()]:
+        if class_id in self.ancestor_id_list():
             return True
         else:
             return False
 
     def descendants(self):
         """
-        Recursively list all descendant classes
+        Recursively list all descendant classes.
+
+        If the class has a materialized path, the descendants are
+        fetched in a single query (by path prefix), and returned in
+        depth-first order.
         """
+        session = object_session(self)
+        if self.path and session is not None:
+            descendants = session.query(ThesClass).\
+                filter(ThesClass.path.like(self.path + PATH_SEPARATOR + '%')).\
+                all()
+            # Siblings are ordered by ID, as in taxonomy_index()
+            return sorted(descendants, key=lambda c: path_ids(c.path))
+
         def recurse(node, stack):
             stack.append(node)
             for child in node.children:
@@ -174,7 +259,7 @@ class ThesInstance(Base):
     __tablename__ = 'tm_thesaurusinstance'
 
     id = Column(Integer, primary_key=True)
-    lemma = Column(String(100), index=True)
+    lemma = Column(String(100))
     refentry = Column(Integer, nullable=False, index=True)
     refid = Column(Integer, nullable=False, index=True)
     start_year = Column(Integer)
@@ -183,11 +268,25 @@ class ThesInstance(Base):
     class_id = Column(Integer, ForeignKey('tm_thesaurusclass.id'))
     thesclass = relationship('ThesClass', backref=backref('instances'))
 
+    # Lemma lookups that also filter or group by class (see leanht.lookup);
+    #  lemma is the leading column, so this also serves lemma-only lookups
+    __table_args__ = (Index('ix_tm_thesaurusinstance_lemma_class',
+                            'lemma', 'class_id'),)
+
     def __init__(self, data):
-        for key, value in data.items():
+        for key, value in self.row_data(data).items():
             self.__dict__[key] = value
-        if self.lemma is not None:
-            self.lemma = self.lemma[0:100]
+
+    @staticmethod
+    def row_data(data):
+        """
+        Return a copy of the data dict, with values trimmed to fit
+        the columns.
+        """
+        data = dict(data)
+        if data.get('lemma') is not None:
+            data['lemma'] = data['lemma'][0:100]
+        return data
 
     def __repr__(self):
         if self.thesclass is not None:
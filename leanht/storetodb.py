@@ -1,44 +1,83 @@
 
+import queue
+import threading
+from collections import defaultdict
+
+import sqlalchemy
 
 from lex.oed.thesaurus.contentiterator import ContentIterator
 from lex.oed.thesaurus.taxonomymanager import TaxonomyManager
 from leanht.models import ThesClass, ThesInstance
+from leanht.bulkload import BulkLoader, recreate_table, create_indexes
+from leanht.taxonomyindex import taxonomy_index
 import textmetricsconfig
+import resources
+import instrumentation
 
 IN_DIR = textmetricsconfig.LEANHT_DIR
-DB_ENGINE = textmetricsconfig.ENGINE
-DB_SESSION = textmetricsconfig.SESSION
+BULK_LOAD = textmetricsconfig.LEANHT_BULK_LOAD
+# Maximum number of class IDs in a single IN (...) clause in a delta load
+DELTA_CHUNK_SIZE = 500
 
 
-def store_taxonomy():
-    ThesInstance.__table__.drop(DB_ENGINE, checkfirst=True)
-    ThesClass.__table__.drop(DB_ENGINE, checkfirst=True)
-    ThesClass.__table__.create(DB_ENGINE, checkfirst=True)
+def store_taxonomy(bulk=BULK_LOAD):
+    engine = _engine()
+    session = None if bulk else _session()
+    ThesInstance.__table__.drop(engine, checkfirst=True)
+    ThesClass.__table__.drop(engine, checkfirst=True)
+    if bulk:
+        recreate_table(engine, ThesClass.__table__)
+        loader = BulkLoader(engine, ThesClass.__table__)
+    else:
+        ThesClass.__table__.create(engine, checkfirst=True)
 
     ci = ContentIterator(path=IN_DIR, fixLigatures=True, verbosity='low')
     valid_ids = {thesclass.id(): thesclass.size()
                  for thesclass in ci.iterate()}
 
     tree_manager = TaxonomyManager(lazy=True, verbosity=None)
+    index = taxonomy_index(tree_manager.classes)
     for level in range(1, 20):
         classes = [c for c in tree_manager.classes if c.level() == level
                    and c.id() in valid_ids]
         print(level, len(classes))
+        if bulk:
+            for thesaurus_class in classes:
+                revised_size = valid_ids[thesaurus_class.id()]
+                loader.add(ThesClass.row_data(
+                    thesaurus_class, size=revised_size,
+                    index=index.get(thesaurus_class.id())))
+            # Flush at the end of each level, so that parent classes
+            #  are always in place before their children
+            loader.flush()
+            continue
         buffer_size = 0
         for thesaurus_class in classes:
             revised_size = valid_ids[thesaurus_class.id()]
-            record = ThesClass(thesaurus_class, size=revised_size)
-            DB_SESSION.add(record)
+            record = ThesClass(thesaurus_class, size=revised_size,
+                               index=index.get(thesaurus_class.id()))
+            session.add(record)
             buffer_size += 1
             if buffer_size > 1000:
-                DB_SESSION.commit()
+                session.commit()
                 buffer_size = 0
-        DB_SESSION.commit()
+        session.commit()
+
+    if bulk:
+        loader.close()
+        create_indexes(engine, ThesClass.__table__)
+        print(loader.report())
 
 
-def store_content():
-    ThesInstance.__table__.drop(DB_ENGINE, checkfirst=True)
-    ThesInstance.__table__.create(DB_ENGINE, checkfirst=True)
+def store_content(bulk=BULK_LOAD):
+    engine = _engine()
+    session = None if bulk else _session()
+    ThesInstance.__table__.drop(engine, checkfirst=True)
+    if bulk:
+        recreate_table(engine, ThesInstance.__table__)
+        loader = BulkLoader(engine, ThesInstance.__table__)
+    else:
+        ThesInstance.__table__.create(engine, checkfirst=True)
 
     ci = ContentIterator(path=IN_DIR, fixLigatures=True, verbosity='low')
     buffer_size = 0
@@ -52,9 +91,363 @@ def store_content():
                 'end_year': instance.end_date(),
                 'class_id': thesclass.id(),
             }
-            DB_SESSION.add(ThesInstance(record_data))
+            if bulk:
+                loader.add(ThesInstance.row_data(record_data))
+                continue
+            session.add(ThesInstance(record_data))
             buffer_size += 1
         if buffer_size > 1000:
-            DB_SESSION.commit()
+            session.commit()
             buffer_size = 0
-    DB_SESSION.commit()
+
+    if bulk:
+        loader.close()
+        create_indexes(engine, ThesInstance.__table__)
+        print(loader.report())
+    else:
+        session.commit()
+
+
+def store_all(queue_size=8, batch_size=10000):
+    """
+    Load both tables from a single pass over the lean HT files.
+
+    Class rows are emitted parent-before-child, and each class's rows
+    are always written before any instance rows that refer to it (only
+    the instances of classes still waiting for their parent are held
+    back; everything else is sent on in batches).
+    Parsing runs in the current thread; rows are handed in batches
+    through a bounded queue to a writer thread, so that parsing
+    overlaps with database writes.
+    """
+    engine = _engine()
+    ThesInstance.__table__.drop(engine, checkfirst=True)
+    ThesClass.__table__.drop(engine, checkfirst=True)
+    recreate_table(engine, ThesClass.__table__)
+    recreate_table(engine, ThesInstance.__table__)
+    loaders = {
+        'class': BulkLoader(engine, ThesClass.__table__,
+                            batch_size=batch_size),
+        'instance': BulkLoader(engine, ThesInstance.__table__,
+                               batch_size=batch_size),
+    }
+    writer = _BatchWriter(loaders, queue_size)
+    writer.start()
+
+    tree_manager = TaxonomyManager(lazy=True, verbosity=None)
+    taxonomy = {c.id(): c for c in tree_manager.classes}
+    index = taxonomy_index(tree_manager.classes)
+
+    class_rows = []
+    instance_rows = []
+    emitted = set()
+    # Classes waiting for their parent to be emitted, keyed by parent ID
+    pending = defaultdict(list)
+    # Instance rows of classes that are waiting, keyed by class ID
+    held = {}
+
+    def emit(class_row):
+        # Emit the class, then any of its descendants that were waiting
+        #  on it (each followed by its held-back instances)
+        stack = [class_row]
+        while stack:
+            row = stack.pop()
+            class_rows.append(row)
+            emitted.add(row['id'])
+            instance_rows.extend(held.pop(row['id'], []))
+            stack.extend(pending.pop(row['id'], []))
+
+    def send():
+        # Classes go first, so that foreign keys are always satisfied
+        writer.put('class', class_rows[:])
+        writer.put('instance', instance_rows[:])
+        del class_rows[:]
+        del instance_rows[:]
+
+    ci = ContentIterator(path=IN_DIR, fixLigatures=True, verbosity='low')
+    try:
+        for thesclass in ci.iterate():
+            thesaurus_class = taxonomy.get(thesclass.id())
+            rows = _instance_rows(thesclass)
+            if thesaurus_class is not None:
+                row = ThesClass.row_data(thesaurus_class, size=thesclass.size(),
+                                         index=index.get(thesclass.id()))
+                row['content_hash'] = ThesClass.compute_hash(row, rows)
+                if row['parent_id'] is None or row['parent_id'] in emitted:
+                    emit(row)
+                else:
+                    # Hold back the instances until the class itself
+                    #  is emitted
+                    pending[row['parent_id']].append(row)
+                    held[row['id']] = rows
+                    continue
+            instance_rows.extend(rows)
+            if len(class_rows) + len(instance_rows) >= batch_size:
+                send()
+
+        # Anything still pending has a parent outside the lean HT;
+        #  emit these in level order.
+        for row in sorted([r for rows in pending.values() for r in rows],
+                          key=lambda r: r['level']):
+            class_rows.append(row)
+            instance_rows.extend(held.pop(row['id'], []))
+        pending.clear()
+        send()
+    finally:
+        writer.finish()
+    for loader in loaders.values():
+        loader.close()
+
+    create_indexes(engine, ThesClass.__table__)
+    create_indexes(engine, ThesInstance.__table__)
+    for loader in loaders.values():
+        print(loader.report())
+
+
+def store_delta():
+    """
+    Bring the tables into line with the lean HT files by applying only
+    the changes, rather than dropping and reloading them.
+
+    Each class's content hash (see ThesClass.compute_hash()) is compared
+    with the hash stored in the table. Then, in a single transaction:
+    new classes are inserted (parents before children); changed classes
+    are updated, and their instances replaced; classes whose path has
+    changed (because an ancestor has moved) get just that column
+    updated; and classes no longer in the lean HT are deleted, with
+    their instances (children before parents). The tables stay readable
+    throughout.
+
+    Instances of classes that aren't in the taxonomy (which store_all()
+    loads all the same, without a class row) are compared directly with
+    those in the table, and replaced if they differ.
+
+    Falls back to store_all() if the tables don't exist yet, or predate
+    the content_hash column.
+    """
+    engine = _engine()
+    class_table = ThesClass.__table__
+    instance_table = ThesInstance.__table__
+    inspector = sqlalchemy.inspect(engine)
+    if (not inspector.has_table(class_table.name) or
+            not inspector.has_table(instance_table.name) or
+            'content_hash' not in [column['name'] for column in
+                                   inspector.get_columns(class_table.name)]):
+        print('No existing tables with content hashes; running a full load')
+        store_all()
+        return
+
+    with engine.connect() as connection:
+        current = {row.id: row for row in connection.execute(
+            sqlalchemy.select(class_table.c.id, class_table.c.level,
+                              class_table.c.path,
+                              class_table.c.content_hash))}
+
+    tree_manager = TaxonomyManager(lazy=True, verbosity=None)
+    taxonomy = {c.id(): c for c in tree_manager.classes}
+    index = taxonomy_index(tree_manager.classes)
+
+    # Only the rows for new or changed classes are held in memory
+    inserts = []
+    updates = []
+    moves = []
+    seen = set()
+    # Instance rows of classes not in the taxonomy, keyed by class ID
+    unlisted = {}
+    ci = ContentIterator(path=IN_DIR, fixLigatures=True, verbosity='low')
+    for thesclass in ci.iterate():
+        thesaurus_class = taxonomy.get(thesclass.id())
+        rows = _instance_rows(thesclass)
+        if thesaurus_class is None:
+            unlisted[thesclass.id()] = rows
+            continue
+        row = ThesClass.row_data(thesaurus_class, size=thesclass.size(),
+                                 index=index.get(thesclass.id()))
+        row['content_hash'] = ThesClass.compute_hash(row, rows)
+        seen.add(row['id'])
+        existing = current.get(row['id'])
+        if existing is None:
+            inserts.append((row, rows))
+        elif existing.content_hash != row['content_hash']:
+            updates.append((row, rows))
+        elif existing.path != row['path']:
+            moves.append({'b_id': row['id'], 'path': row['path']})
+    deletes = sorted(set(current) - seen,
+                     key=lambda class_id: current[class_id].level or 0,
+                     reverse=True)
+    unlisted_deletes, unlisted_inserts = _unlisted_changes(engine, unlisted)
+
+    counts = {'inserted': len(inserts), 'updated': len(updates),
+              'moved': len(moves), 'deleted': len(deletes),
+              'unchanged': len(seen) - len(inserts) - len(updates) - len(moves)}
+    for name, n in counts.items():
+        instrumentation.count('delta.' + name, n)
+    print('Delta load: ' + ', '.join('%d %s' % (n, name)
+                                     for name, n in counts.items()))
+    if unlisted_deletes or unlisted_inserts:
+        print('Classes not in the taxonomy: %d with instances removed, '
+              '%d instances inserted' %
+              (len(unlisted_deletes), len(unlisted_inserts)))
+    if (not inserts and not updates and not moves and not deletes and
+            not unlisted_deletes and not unlisted_inserts):
+        for table in (class_table, instance_table):
+            instrumentation.count('db_rows.' + table.name, 0)
+        return
+
+    # Parents before children
+    inserts.sort(key=lambda item: index[item[0]['id']][0])
+    replaced = [row['id'] for row, _ in updates] + deletes + \
+        unlisted_deletes
+    # Rows inserted, updated or deleted, by table
+    written = {class_table.name: len(inserts) + len(updates) + len(moves) +
+               len(deletes)}
+    with engine.begin() as connection:
+        if inserts:
+            connection.execute(class_table.insert(),
+                               [row for row, _ in inserts])
+        if updates:
+            connection.execute(
+                class_table.update().
+                where(class_table.c.id == sqlalchemy.bindparam('b_id')),
+                [_update_params(row) for row, _ in updates])
+        if moves:
+            connection.execute(
+                class_table.update().
+                where(class_table.c.id == sqlalchemy.bindparam('b_id')).
+                values(path=sqlalchemy.bindparam('path')),
+                moves)
+        removed = 0
+        for i in range(0, len(replaced), DELTA_CHUNK_SIZE):
+            removed += connection.execute(instance_table.delete().where(
+                instance_table.c.class_id.in_(
+                    replaced[i:i + DELTA_CHUNK_SIZE]))).rowcount
+        new_instances = [instance for _, rows in inserts + updates
+                         for instance in rows]
+        if new_instances:
+            connection.execute(instance_table.insert(), new_instances)
+        if deletes:
+            connection.execute(
+                class_table.delete().
+                where(class_table.c.id == sqlalchemy.bindparam('b_id')),
+                [{'b_id': class_id} for class_id in deletes])
+        # After the class deletes, since a class that has dropped out of
+        #  the taxonomy keeps its ID
+        if unlisted_inserts:
+            connection.execute(instance_table.insert(), unlisted_inserts)
+        written[instance_table.name] = removed + len(new_instances) + \
+            len(unlisted_inserts)
+    for table_name, n in written.items():
+        instrumentation.count('db_rows.' + table_name, n)
+
+
+def _unlisted_changes(engine, unlisted):
+    """
+    Compare the instance rows of classes not in the taxonomy (keyed by
+    class ID) with the instances in the table whose class has no row
+    in the class table.
+
+    Returns a list of the IDs of classes whose instances are to be
+    deleted (because they've changed, or the class is no longer in the
+    lean HT), and a list of the instance rows to be inserted.
+    """
+    class_table = ThesClass.__table__
+    instance_table = ThesInstance.__table__
+    with engine.connect() as connection:
+        stored = {class_id for (class_id,) in connection.execute(
+            sqlalchemy.select(instance_table.c.class_id).distinct().
+            where(instance_table.c.class_id.isnot(None)).
+            where(~sqlalchemy.exists().where(
+                class_table.c.id == instance_table.c.class_id)))}
+        existing = defaultdict(list)
+        class_ids = sorted(stored & set(unlisted))
+        for i in range(0, len(class_ids), DELTA_CHUNK_SIZE):
+            for row in connection.execute(
+                    sqlalchemy.select(instance_table).
+                    where(instance_table.c.class_id.in_(
+                        class_ids[i:i + DELTA_CHUNK_SIZE]))):
+                existing[row.class_id].append(_instance_values(row._mapping))
+
+    deletes = sorted(stored - set(unlisted))
+    inserts = []
+    for class_id, rows in sorted(unlisted.items()):
+        if class_id in stored:
+            if sorted(existing[class_id]) == \
+                    sorted(_instance_values(row) for row in rows):
+                continue
+            deletes.append(class_id)
+        inserts.extend(rows)
+    return deletes, inserts
+
+
+def _instance_values(row):
+    return tuple(row[column] for column in
+                 ('lemma', 'refentry', 'refid', 'start_year', 'end_year'))
+
+
+def _update_params(row):
+    params = {key: value for key, value in row.items() if key != 'id'}
+    params['b_id'] = row['id']
+    return params
+
+
+def _instance_rows(thesclass):
+    return [ThesInstance.row_data({
+        'lemma': instance.lemma(),
+        'refentry': instance.refentry(),
+        'refid': instance.refid(),
+        'start_year': instance.start_date(),
+        'end_year': instance.end_date(),
+        'class_id': thesclass.id(),
+    }) for instance in thesclass.instances()]
+
+
+class _BatchWriter(threading.Thread):
+
+    """
+    Writer thread: takes (table, rows) batches off a bounded queue and
+    writes them with the corresponding BulkLoader, in queue order.
+    """
+
+    def __init__(self, loaders, queue_size):
+        threading.Thread.__init__(self, daemon=True)
+        self.loaders = loaders
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+
+    def put(self, table, rows):
+        if self.error is not None:
+            raise self.error
+        if rows:
+            self.queue.put((table, rows))
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep draining, so that the parser is never left
+                #  blocked on a full queue
+                continue
+            table, rows = item
+            try:
+                self.loaders[table].add_all(rows)
+                self.loaders[table].flush()
+            except Exception as error:
+                self.error = error
+
+
+def _engine():
+    # The database engine and session are created on first use (see
+    #  textmetricsconfig), not when this module is imported
+    return resources.get('db_engine')
+
+
+def _session():
+    return resources.get('db_session')
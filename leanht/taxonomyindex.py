@@ -0,0 +1,70 @@
+"""
+taxonomyindex -- nested-set bounds and materialized paths for the taxonomy
+
+Each class gets:
+    lft, rgt:   nested-set bounds (a class's descendants are exactly the
+                classes with lft > its lft and rgt < its rgt);
+    path:       the IDs of its ancestors, from the root down to and
+                including the class itself, joined by PATH_SEPARATOR.
+
+Only the path is stored in the tm_thesaurusclass table: it lets
+ThesClass answer ancestor and descendant queries in a single query
+(or with no query at all), rather than walking the tree one lazy-loaded
+relationship at a time, and it only changes for classes whose ancestry
+changes. Nested-set bounds shift for most of the tree whenever a class
+is added or removed, which would defeat a delta load (see
+leanht.storetodb.store_delta()); they are used for building taxonomy
+snapshots, which are always written afresh.
+
+@author: James McCracken
+"""
+
+PATH_SEPARATOR = '/'
+
+
+def taxonomy_index(classes):
+    """
+    Compute (lft, rgt, path) for each of a collection of thesaurus
+    classes (as returned by TaxonomyManager, i.e. with id() and parent()
+    methods).
+
+    Returns a dict keyed by class ID. Siblings are ordered by ID;
+    classes whose parent is not in the collection are treated as roots.
+    """
+    parents = {c.id(): c.parent() for c in classes}
+    children = {}
+    roots = []
+    for class_id, parent_id in parents.items():
+        if parent_id is None or parent_id not in parents:
+            roots.append(class_id)
+        else:
+            children.setdefault(parent_id, []).append(class_id)
+
+    index = {}
+    counter = 0
+    # Iterative depth-first traversal (to avoid hitting the recursion
+    #  limit); each stack item is (class ID, path, visited flag)
+    stack = [(class_id, str(class_id), False)
+             for class_id in sorted(roots, reverse=True)]
+    left = {}
+    while stack:
+        class_id, path, visited = stack.pop()
+        counter += 1
+        if visited:
+            index[class_id] = (left[class_id], counter, path)
+            continue
+        left[class_id] = counter
+        stack.append((class_id, path, True))
+        for child_id in sorted(children.get(class_id, []), reverse=True):
+            stack.append((child_id, path + PATH_SEPARATOR + str(child_id),
+                          False))
+    return index
+
+
+def path_ids(path):
+    """
+    Return the list of class IDs in a materialized path (root first).
+    """
+    if not path:
+        return []
+    return [int(class_id) for class_id in path.split(PATH_SEPARATOR)]
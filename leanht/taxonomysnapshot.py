@@ -0,0 +1,371 @@
+"""
+taxonomysnapshot -- read-only, memory-mapped snapshot of the HT-lean taxonomy
+
+export_snapshot() writes the tm_thesaurusclass table to a flat binary
+file: classes are stored in depth-first order as parallel int32 arrays
+(ID, parent position, end of subtree, level, node size, branch size),
+plus an ID-sorted lookup array and a UTF-8 string pool for labels and
+wordclasses.
+
+TaxonomySnapshot memory-maps the file, so any number of processes can
+share a single page-cache copy and open it in milliseconds. Classes
+are returned as SnapshotClass views, which support the same read-only
+interface as leanht.models.ThesClass (attributes, breadcrumbs,
+ancestors, descendants, is_descendant_of, etc.); tree navigation is
+pure array arithmetic.
+
+@author: James McCracken
+"""
+
+import sys
+import mmap
+import array
+import bisect
+import struct
+
+from leanht.models import ThesClass
+from leanht.taxonomyindex import taxonomy_index
+
+MAGIC = b'TMTX'
+VERSION = 1
+
+_INT_ARRAYS = ('ids', 'parents', 'ends', 'levels', 'node_sizes',
+               'branch_sizes', 'sorted_ids', 'sorted_positions')
+_OFFSET_ARRAYS = ('label_offsets', 'wordclass_offsets')
+_SECTIONS = _INT_ARRAYS + _OFFSET_ARRAYS + ('pool',)
+# magic, version, byte-order flag, class count, then (offset, length)
+#  for each section
+_HEADER = struct.Struct('<4sHHI' + 'QQ' * len(_SECTIONS))
+_BYTEORDER = {'little': 1, 'big': 2}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def export_snapshot(engine, out_file):
+    """
+    Write the contents of the tm_thesaurusclass table to a snapshot file.
+    """
+    table = ThesClass.__table__
+    with engine.connect() as connection:
+        rows = {row.id: row for row in connection.execute(table.select())}
+
+    # Depth-first order (recomputed here, so that the snapshot doesn't
+    #  depend on the table's lft/rgt columns being populated)
+    index = taxonomy_index([_RowAdapter(row) for row in rows.values()])
+    order = sorted(rows, key=lambda class_id: index[class_id][0])
+    positions = {class_id: i for i, class_id in enumerate(order)}
+
+    arrays = {name: array.array('i') for name in _INT_ARRAYS}
+    arrays.update({name: array.array('I', [0]) for name in _OFFSET_ARRAYS})
+    pools = {name: bytearray() for name in _OFFSET_ARRAYS}
+    for class_id in order:
+        row = rows[class_id]
+        lft, rgt, _ = index[class_id]
+        arrays['ids'].append(class_id)
+        arrays['parents'].append(positions.get(row.parent_id, -1))
+        # Number of classes in the subtree = (rgt - lft + 1) / 2
+        arrays['ends'].append(positions[class_id] + (rgt - lft + 1) // 2)
+        arrays['levels'].append(row.level or 0)
+        arrays['node_sizes'].append(row.node_size or 0)
+        arrays['branch_sizes'].append(row.branch_size or 0)
+        for name, value in (('label_offsets', row.label),
+                            ('wordclass_offsets', row.wordclass)):
+            pools[name] += (value or '').encode('utf8')
+            arrays[name].append(len(pools[name]))
+    for class_id in sorted(order):
+        arrays['sorted_ids'].append(class_id)
+        arrays['sorted_positions'].append(positions[class_id])
+
+    # Labels and wordclasses share a single pool; shift the wordclass
+    #  offsets to point past the labels
+    label_length = len(pools['label_offsets'])
+    arrays['wordclass_offsets'] = array.array(
+        'I', [offset + label_length for offset in arrays['wordclass_offsets']])
+    pool = pools['label_offsets'] + pools['wordclass_offsets']
+
+    sections = [arrays[name].tobytes() for name in _INT_ARRAYS + _OFFSET_ARRAYS]
+    sections.append(bytes(pool))
+    offset = _HEADER.size
+    locations = []
+    for section in sections:
+        offset = _align(offset)
+        locations.extend((offset, len(section)))
+        offset += len(section)
+
+    with open(out_file, 'wb') as filehandle:
+        filehandle.write(_HEADER.pack(MAGIC, VERSION,
+                                      _BYTEORDER[sys.byteorder],
+                                      len(order), *locations))
+        for section, location in zip(sections, locations[::2]):
+            filehandle.write(b'\0' * (location - filehandle.tell()))
+            filehandle.write(section)
+
+
+class TaxonomySnapshot(object):
+
+    """
+    Read-only view over a snapshot file.
+
+    Usage:
+        snapshot = TaxonomySnapshot(path)
+        thesclass = snapshot.get(12345)
+        print(thesclass.breadcrumb())
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._filehandle = open(path, 'rb')
+        self._map = mmap.mmap(self._filehandle.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        fields = _HEADER.unpack_from(self._map, 0)
+        magic, version, byteorder, self.count = fields[0:4]
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise SnapshotError('%s is not a version %d taxonomy snapshot'
+                                % (path, VERSION))
+        if byteorder != _BYTEORDER[sys.byteorder]:
+            self.close()
+            raise SnapshotError('%s was written on a machine with different '
+                                'byte order' % path)
+        view = memoryview(self._map)
+        locations = fields[4:]
+        for i, name in enumerate(_SECTIONS):
+            offset, length = locations[2 * i], locations[2 * i + 1]
+            section = view[offset:offset + length]
+            if name in _INT_ARRAYS:
+                section = section.cast('i')
+            elif name in _OFFSET_ARRAYS:
+                section = section.cast('I')
+            setattr(self, '_' + name, section)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Iterate through all classes, in depth-first order.
+        """
+        for position in range(self.count):
+            yield SnapshotClass(self, position)
+
+    def __contains__(self, class_id):
+        return self._position(class_id) is not None
+
+    def __getitem__(self, class_id):
+        thesclass = self.get(class_id)
+        if thesclass is None:
+            raise KeyError(class_id)
+        return thesclass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, class_id):
+        """
+        Return the class with the given ID (or None if not found).
+        """
+        position = self._position(class_id)
+        if position is None:
+            return None
+        return SnapshotClass(self, position)
+
+    def roots(self):
+        return [SnapshotClass(self, position) for position in range(self.count)
+                if self._parents[position] == -1]
+
+    def close(self):
+        for name in _SECTIONS:
+            section = getattr(self, '_' + name, None)
+            if section is not None:
+                section.release()
+                setattr(self, '_' + name, None)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._filehandle.close()
+
+    def _position(self, class_id):
+        class_id = int(class_id)
+        i = bisect.bisect_left(self._sorted_ids, class_id)
+        if i < self.count and self._sorted_ids[i] == class_id:
+            return self._sorted_positions[i]
+        return None
+
+    def _string(self, offsets, position):
+        return bytes(self._pool[offsets[position]:
+                                offsets[position + 1]]).decode('utf8') or None
+
+
+class SnapshotClass(object):
+
+    """
+    A single class in a TaxonomySnapshot, with the same read-only
+    interface as leanht.models.ThesClass.
+    """
+
+    __slots__ = ('_snapshot', '_position')
+
+    def __init__(self, snapshot, position):
+        self._snapshot = snapshot
+        self._position = position
+
+    def __repr__(self):
+        return '<ThesClass %d (%s)>' % (self.id, self.signature())
+
+    def __eq__(self, other):
+        return int(self.id) == int(other.id)
+
+    def __hash__(self):
+        return int(self.id)
+
+    @property
+    def id(self):
+        return self._snapshot._ids[self._position]
+
+    @property
+    def label(self):
+        return self._snapshot._string(self._snapshot._label_offsets,
+                                      self._position)
+
+    @property
+    def wordclass(self):
+        return self._snapshot._string(self._snapshot._wordclass_offsets,
+                                      self._position)
+
+    @property
+    def level(self):
+        return self._snapshot._levels[self._position]
+
+    @property
+    def node_size(self):
+        return self._snapshot._node_sizes[self._position]
+
+    @property
+    def branch_size(self):
+        return self._snapshot._branch_sizes[self._position]
+
+    @property
+    def parent_id(self):
+        parent = self.parent
+        if parent is None:
+            return None
+        return parent.id
+
+    @property
+    def parent(self):
+        position = self._snapshot._parents[self._position]
+        if position == -1:
+            return None
+        return SnapshotClass(self._snapshot, position)
+
+    @property
+    def children(self):
+        # Each child's subtree ends where the next child begins, so
+        #  step from child to child rather than scanning the subtree
+        ends = self._snapshot._ends
+        children = []
+        position = self._position + 1
+        end = self._end()
+        while position < end:
+            children.append(SnapshotClass(self._snapshot, position))
+            position = ends[position]
+        return children
+
+    def signature(self):
+        sig = ''
+        if self.wordclass is not None:
+            sig += '[' + self.wordclass + '] '
+        if self.label is not None and self.label:
+            sig += self.label
+        return sig.strip()
+
+    def breadcrumb_components(self):
+        return [ancestor.signature() for ancestor in self.ancestors_descending()]
+
+    def breadcrumb(self):
+        return ' > '.join(self.breadcrumb_components()[1:])
+
+    def breadcrumb_tail(self):
+        return ' > '.join(self.breadcrumb_components()[-3:])
+
+    def breadcrumb_short(self):
+        return ' > '.join(self.breadcrumb_components()[1:3]) + ' ... ' + \
+            ' > '.join(self.breadcrumb_components()[-3:])
+
+    def ancestors(self):
+        """
+        Return a list of ancestor classes in ascending order,
+        beginning with self.
+        """
+        ancestors = []
+        position = self._position
+        while position != -1:
+            ancestors.append(SnapshotClass(self._snapshot, position))
+            position = self._snapshot._parents[position]
+        return ancestors
+
+    def ancestors_ascending(self):
+        return self.ancestors()
+
+    def ancestors_descending(self):
+        return list(reversed(self.ancestors()))
+
+    def ancestor_id_list(self):
+        return [a.id for a in self.ancestors_descending()]
+
+    def ancestor_ids(self):
+        return set(self.ancestor_id_list())
+
+    def ancestor(self, level=1):
+        for ancestor in self.ancestors():
+            if ancestor.level == level:
+                return ancestor
+        return None
+
+    def is_descendant_of(self, class_id):
+        """
+        Return True is the present class is a descendant of the argument
+        (either another class object, or a thesaurus class ID).
+        """
+        if class_id is None or not class_id:
+            return False
+        if not isinstance(class_id, int):
+            class_id = getattr(class_id, 'id', class_id)
+        position = self._snapshot._position(class_id)
+        if position is None:
+            return False
+        return position <= self._position < self._snapshot._ends[position]
+
+    def descendants(self):
+        """
+        List all descendant classes, in depth-first order.
+        """
+        return [SnapshotClass(self._snapshot, position) for position
+                in range(self._position + 1, self._end())]
+
+    def oed_url(self):
+        return 'http://www.oed.com/view/th/class/%d' % self.id
+
+    def _end(self):
+        return self._snapshot._ends[self._position]
+
+
+class _RowAdapter(object):
+
+    def __init__(self, row):
+        self.row = row
+
+    def id(self):
+        return self.row.id
+
+    def parent(self):
+        return self.row.parent_id
+
+
+def _align(offset, boundary=8):
+    return (offset + boundary - 1) // boundary * boundary
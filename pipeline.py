@@ -1,49 +1,138 @@
+#!/usr/bin/env python
 """
 pipeline -- runs processes for building data for the text analysis app.
 
+Stages are run in the order given in textmetricsconfig.PIPELINE, if
+flagged there. Each stage declares the stages it depends on, and its
+input and output paths; a flagged stage is skipped if its inputs and
+outputs are unchanged since its last complete run (stages with no
+declared inputs always run). Stages that work letter-by-letter
+checkpoint each letter, so an interrupted run resumes where it stopped.
+
 @author: James McCracken
 """
 
-import textmetricsconfig
-
-
-def dispatch():
-    for function_name, status in textmetricsconfig.PIPELINE:
-        if status:
-            print('=' * 30)
-            print('Running "%s"...' % function_name)
-            print('=' * 30)
-            function = globals()[function_name]
-            function()
-
+import os
 
-def make_leanht():
-    from leanht.makeleanht import make_lean_ht
-    make_lean_ht()
-
-
-def store_leanht():
-    from leanht.storetodb import store_content, store_taxonomy
-    store_taxonomy()
-    store_content()
-
-
-def index_proper():
-    from build.formindexer import FormIndexer
-    form_indexer = FormIndexer()
+import textmetricsconfig
+import resources
+from instrumentation import RunReport
+from pipelinestate import PipelineState, fingerprint
+
+RAW_DIR = os.path.join(textmetricsconfig.FORM_INDEX_DIR, 'raw')
+REFINED_DIR = os.path.join(textmetricsconfig.FORM_INDEX_DIR, 'refined')
+PROPER_NAMES_DIR = os.path.join(textmetricsconfig.FORM_INDEX_DIR,
+                                'proper_names')
+SOURCES = textmetricsconfig.PIPELINE_SOURCES
+
+# name: (dependencies, inputs, outputs)
+STAGES = {
+    'make_leanht': ((), SOURCES.get('make_leanht', []),
+                    [textmetricsconfig.LEANHT_DIR]),
+    'store_leanht': (('make_leanht',), [textmetricsconfig.LEANHT_DIR], []),
+    'snapshot_leanht': (('store_leanht',), [textmetricsconfig.LEANHT_DIR],
+                        [textmetricsconfig.TAXONOMY_SNAPSHOT_FILE]),
+    'index_forms': ((), SOURCES.get('index_forms', []), [RAW_DIR]),
+    'refine_forms': (('index_forms',), [RAW_DIR], [REFINED_DIR]),
+    'index_proper': ((), SOURCES.get('index_proper', []), [PROPER_NAMES_DIR]),
+}
+
+# Stages whose letter checkpoints are fingerprints of each letter's own
+#  inputs, and so remain valid from one run to the next
+LETTER_FINGERPRINT_STAGES = ('refine_forms',)
+
+
+def dispatch(force=textmetricsconfig.PIPELINE_FORCE):
+    state = PipelineState(textmetricsconfig.PIPELINE_STATE_FILE)
+    report = RunReport(profile_stage=textmetricsconfig.PROFILE_STAGE,
+                       out_dir=textmetricsconfig.REPORT_DIR)
+    try:
+        _run_stages(state, report, force)
+    finally:
+        report.startup = resources.startup_report()
+        print('Startup (import and resource initialization) times:')
+        resources.print_startup_report()
+        print('Run report written to %s' % report.write())
+
+
+def _run_stages(state, report, force):
+    for function_name, status in _ordered_stages(textmetricsconfig.PIPELINE):
+        if not status:
+            continue
+        _, inputs, outputs = STAGES[function_name]
+        input_fingerprint = fingerprint(inputs) if inputs else None
+        if (not force and
+                state.is_up_to_date(function_name, input_fingerprint,
+                                    fingerprint(outputs))):
+            print('"%s" is up to date; skipping' % function_name)
+            continue
+
+        print('=' * 30)
+        print('Running "%s"...' % function_name)
+        print('=' * 30)
+        checkpoint = state.start(
+            function_name, input_fingerprint,
+            keep_letters=(function_name in LETTER_FINGERPRINT_STAGES and
+                          not force))
+        function = globals()[function_name]
+        with report.stage(function_name):
+            function(checkpoint=checkpoint)
+        state.finish(function_name, fingerprint(outputs))
+
+
+def _ordered_stages(pipeline):
+    """
+    Return the pipeline with stages reordered (if necessary) so that
+    each stage comes after any stage it depends on.
+    """
+    ordered = []
+    remaining = list(pipeline)
+    while remaining:
+        names = set(name for name, _ in remaining)
+        for i, (name, status) in enumerate(remaining):
+            if not names.intersection(STAGES[name][0]):
+                ordered.append(remaining.pop(i))
+                break
+        else:
+            raise ValueError('Circular stage dependencies in pipeline')
+    return ordered
+
+
+def make_leanht(checkpoint=None):
+    makeleanht = resources.timed_import('leanht.makeleanht')
+    makeleanht.make_lean_ht()
+
+
+def store_leanht(checkpoint=None):
+    storetodb = resources.timed_import('leanht.storetodb')
+    if textmetricsconfig.LEANHT_DELTA_LOAD:
+        storetodb.store_delta()
+    else:
+        storetodb.store_all()
+
+
+def snapshot_leanht(checkpoint=None):
+    taxonomysnapshot = resources.timed_import('leanht.taxonomysnapshot')
+    taxonomysnapshot.export_snapshot(textmetricsconfig.ENGINE,
+                                     textmetricsconfig.TAXONOMY_SNAPSHOT_FILE)
+
+
+def index_proper(checkpoint=None):
+    formindexer = resources.timed_import('build.formindexer')
+    form_indexer = formindexer.FormIndexer()
     form_indexer.index_proper_names()
 
 
-def index_forms():
-    from build.formindexer import FormIndexer
-    form_indexer = FormIndexer()
-    form_indexer.index_raw_forms()
+def index_forms(checkpoint=None):
+    formindexer = resources.timed_import('build.formindexer')
+    form_indexer = formindexer.FormIndexer()
+    form_indexer.index_raw_forms(checkpoint=checkpoint)
 
 
-def refine_forms():
-    from build.formindexer import FormIndexer
-    form_indexer = FormIndexer()
-    form_indexer.refine_index()
+def refine_forms(checkpoint=None):
+    formindexer = resources.timed_import('build.formindexer')
+    form_indexer = formindexer.FormIndexer()
+    form_indexer.refine_index(checkpoint=checkpoint)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+"""
+pipelinestate -- fingerprints and checkpoints for incremental pipeline runs
+
+PipelineState persists, for each stage, the fingerprints of its inputs
+and outputs at the end of its last complete run, plus per-letter
+checkpoints. pipeline.dispatch() uses this to skip stages that are up
+to date, to redo only the letters whose inputs have changed, and to
+resume an interrupted stage from the last finished letter.
+
+@author: James McCracken
+"""
+
+import os
+import json
+import hashlib
+
+
+def fingerprint(paths):
+    """
+    Return a cheap fingerprint of a list of files and/or directories,
+    based on the path, size and modification time of each file.
+    """
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(path.encode('utf8'))
+        if os.path.isdir(path):
+            files = []
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, f) for f in filenames)
+        elif os.path.exists(path):
+            files = [path]
+        else:
+            digest.update(b'\0missing')
+            continue
+        for filepath in sorted(files):
+            stat = os.stat(filepath)
+            digest.update(('%s\t%d\t%d\n' % (os.path.relpath(filepath, path),
+                                             stat.st_size,
+                                             stat.st_mtime_ns)).encode('utf8'))
+    return digest.hexdigest()
+
+
+def content_fingerprint(path, *extra):
+    """
+    Return a fingerprint of the contents of a single file (plus any
+    extra strings), so that a file rewritten with identical contents
+    is not treated as changed.
+    """
+    digest = hashlib.sha1()
+    if os.path.exists(path):
+        with open(path, 'rb') as filehandle:
+            for chunk in iter(lambda: filehandle.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(b'\0missing')
+    for value in extra:
+        digest.update(b'\0' + value.encode('utf8'))
+    return digest.hexdigest()
+
+
+class PipelineState(object):
+
+    """
+    Stage records, persisted as JSON after every change so that an
+    interrupted run can be resumed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as filehandle:
+                self.stages = json.load(filehandle)
+        except FileNotFoundError:
+            self.stages = {}
+
+    def stage(self, name):
+        return self.stages.setdefault(name, {'complete': False,
+                                             'inputs': None,
+                                             'outputs': None,
+                                             'letters': {}})
+
+    def is_up_to_date(self, name, inputs, outputs):
+        record = self.stage(name)
+        return (record['complete'] and
+                inputs is not None and
+                record['inputs'] == inputs and
+                record['outputs'] == outputs)
+
+    def start(self, name, inputs, keep_letters=False):
+        """
+        Mark a stage as started, and return its LetterCheckpoint.
+
+        Letter checkpoints are carried over if keep_letters is True
+        (for stages whose letter tokens are fingerprints of the letter's
+        own inputs); otherwise only if resuming an interrupted run
+        against the same inputs.
+        """
+        record = self.stage(name)
+        if not keep_letters and (record['complete'] or
+                                 record['inputs'] != inputs):
+            record['letters'] = {}
+        record['complete'] = False
+        record['inputs'] = inputs
+        self.save()
+        return LetterCheckpoint(self, name)
+
+    def finish(self, name, outputs):
+        record = self.stage(name)
+        record['complete'] = True
+        record['outputs'] = outputs
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w') as filehandle:
+            json.dump(self.stages, filehandle, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.path)
+
+
+class LetterCheckpoint(object):
+
+    """
+    Per-letter checkpoints for a stage.
+
+    A letter is done if it was completed with the same token; the token
+    is a fingerprint of the letter's inputs (or None, if the stage
+    can only checkpoint within a single run).
+    """
+
+    def __init__(self, state, stage_name):
+        self.state = state
+        self.stage_name = stage_name
+
+    def _letters(self):
+        return self.state.stage(self.stage_name)['letters']
+
+    def is_done(self, letter, token=None):
+        return letter in self._letters() and self._letters()[letter] == token
+
+    def done(self, letter, token=None):
+        self._letters()[letter] = token
+        self.state.save()
@@ -0,0 +1,127 @@
+"""
+resources -- lazily-created shared resources, with startup timings
+
+Expensive shared objects (the database engine and session, lex lookup
+caches) are registered here with a factory function, and created on
+first use by get(), rather than at import time; so a pipeline run that
+doesn't touch the database never connects to it. Each resource is
+created once, and shared by everything in the process.
+
+The time taken to create each resource is recorded, along with the
+time taken by any imports made through timed_import(); startup_report()
+returns both (and is included in the pipeline's run report).
+
+@author: James McCracken
+"""
+
+import sys
+import time
+import threading
+import importlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_LOCK = threading.RLock()
+_FACTORIES = {}
+_INSTANCES = {}
+_RESOURCE_TIMES = OrderedDict()
+_IMPORT_TIMES = OrderedDict()
+
+
+def register(name, factory):
+    """
+    Register a factory function (taking no arguments) for the named
+    resource. Re-registering a name replaces the factory, but not any
+    instance already created.
+    """
+    _FACTORIES[name] = factory
+
+
+def get(name):
+    """
+    Return the named resource, creating it on first use.
+    """
+    try:
+        return _INSTANCES[name]
+    except KeyError:
+        pass
+    with _LOCK:
+        if name not in _INSTANCES:
+            try:
+                factory = _FACTORIES[name]
+            except KeyError:
+                raise KeyError('No resource registered as "%s"' % name)
+            started = time.time()
+            _INSTANCES[name] = factory()
+            _RESOURCE_TIMES[name] = round(time.time() - started, 4)
+        return _INSTANCES[name]
+
+
+def is_created(name):
+    return name in _INSTANCES
+
+
+def reset(name=None):
+    """
+    Discard the named resource (or all resources), so that it's
+    created afresh on next use.
+    """
+    with _LOCK:
+        if name is None:
+            _INSTANCES.clear()
+        else:
+            _INSTANCES.pop(name, None)
+
+
+@contextmanager
+def override(**resources):
+    """
+    Temporarily replace resources with the values given (e.g. a test
+    database engine), restoring the previous state afterwards.
+
+    Usage:
+        with resources.override(db_engine=engine, db_session=session):
+            ...
+    """
+    with _LOCK:
+        missing = object()
+        originals = {name: _INSTANCES.get(name, missing) for name in resources}
+        _INSTANCES.update(resources)
+    try:
+        yield
+    finally:
+        with _LOCK:
+            for name, value in originals.items():
+                if value is missing:
+                    _INSTANCES.pop(name, None)
+                else:
+                    _INSTANCES[name] = value
+
+
+def timed_import(module_name):
+    """
+    Import and return a module, recording how long the import took
+    (if it wasn't already imported).
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    started = time.time()
+    module = importlib.import_module(module_name)
+    _IMPORT_TIMES[module_name] = round(time.time() - started, 4)
+    return module
+
+
+def startup_report():
+    """
+    Return the import and resource-creation times recorded so far
+    (in seconds).
+    """
+    return {'imports': dict(_IMPORT_TIMES),
+            'resources': dict(_RESOURCE_TIMES)}
+
+
+def print_startup_report():
+    report = startup_report()
+    for section in ('imports', 'resources'):
+        for name, seconds in report[section].items():
+            print('  %-10s %-35s %.2fs' % (section[:-1], name, seconds))